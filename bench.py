@@ -0,0 +1,286 @@
+"""
+Layout benchmarks for the engine and the CMN rules.
+
+Builds deterministic scores of growing size and times the phases of rendering them
+separately. Small scores are rendered repeatedly until every phase adds up to
+MIN_TIME (for at most REPEAT_TIME seconds) and their times averaged. Results are printed and can be saved as json (--json). The run fails
+(exit status 1) if a phase's time grows faster with the score size than
+MAX_EXPONENT permits, e.g. when quadratic behaviour has crept back in, or if it is
+slower than TOLERANCE times the same phase in a baseline file (--baseline, a json
+saved by an earlier run). Line breaking is checked against brute force as well,
+beaming against known groupings.
+
+python bench.py                       # 10, 100, 1000 and 10000 notes
+python bench.py 100 1000 10000 --json out.json
+python bench.py --baseline out.json
+python bench.py 1000 --trace rules.json   # open in chrome://tracing or Perfetto
+"""
+
+import argparse
+import contextlib
+import itertools
+import json
+import math
+import os
+import random
+import sys
+import tempfile
+import time
+
+import cmn
+S = cmn.S
+E = S.E
+
+
+SIZES = (10, 100, 1000, 10000)
+# Notes per system.
+SYSTEM_NOTES = 20
+DURATIONS = ("w", "h", "q", "q", "8")
+ACCIDENTAL_RATE = .15
+# Phases timed, in the order they run. lineup is spent inside of rules, which are 
+# broken down further by the engine's rule profiling.
+PHASES = ("construct", "rules", "lineup", "layout", "pack", "save")
+# Largest permitted growth exponent t ~ n^k of a phase over the sizes measured.
+MAX_EXPONENT = 1.3
+# Permitted slowdown against a baseline.
+TOLERANCE = 1.5
+# Line breaking is compared to brute force on this many random pieces of up to 
+# BREAK_CHUNKS chunks.
+BREAK_TRIALS = 200
+BREAK_CHUNKS = 9
+# Shorter times (summed over the repetitions) are too noisy to be checked.
+MIN_TIME = .05
+# A score is rendered again until each phase adds up to MIN_TIME, unless this many
+# seconds have been spent on it.
+REPEAT_TIME = 3
+MAX_REPEATS = 200
+
+
+def build_score(notes, seed=0):
+    """Returns a list of systems holding notes notes of mixed durations, some of
+    them preceded by accidentals. The same arguments always build the same score."""
+    r = random.Random(seed)
+    systems = []
+    for i, start in enumerate(range(0, notes, SYSTEM_NOTES)):
+        content = [S.Clef(pitch="g"), S.SimpleTimeSig(denom=4)]
+        for _ in range(min(SYSTEM_NOTES, notes - start)):
+            if r.random() < ACCIDENTAL_RATE:
+                content.append(S.Accidental(pitch="c"))
+            content.append(S.Note(domain="treble", duration=r.choice(DURATIONS), pitch=["c", 4]))
+        systems.append(cmn.System(content, width=E.mmtopx(180), x=40, y=40 + i * 100))
+    return systems
+
+
+class _Timer:
+    """Accumulates the time spent in functions wrapped by it."""
+    def __init__(self):
+        self.total = 0
+        self._depth = 0
+
+    def wrap(self, func):
+        def timed(*args, **kwargs):
+            # Only the outermost of nested calls counts.
+            self._depth += 1
+            t = time.perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self._depth -= 1
+                if not self._depth: self.total += time.perf_counter() - t
+        return timed
+
+
+@contextlib.contextmanager
+def _timed_lineups(timer):
+    """Times the lineups of all forms."""
+    originals = {cls: cls.__dict__["_lineup"] for cls in (E.HForm, E.VForm)}
+    for cls, lineup in originals.items(): cls._lineup = timer.wrap(lineup)
+    try:
+        yield
+    finally:
+        for cls, lineup in originals.items(): cls._lineup = lineup
+
+
+def run(notes, seed=0, debug=False, trace=None):
+    """Renders a score of notes notes and returns the seconds spent per phase and the
+    stats of each rule (see engine.RuleProfile), named "ruletable:order:description".
+    The rule applications are saved as a Chrome trace at trace if given."""
+    ctx = E._RenderContext(debug=debug)
+    times = {}
+    t = time.perf_counter()
+    systems = build_score(notes, seed)
+    times["construct"] = time.perf_counter() - t
+    lineups = _Timer()
+    with _timed_lineups(lineups), E.profile_rules() as profile:
+        t = time.perf_counter()
+        for system in systems: system._apply_rules()
+        times["rules"] = time.perf_counter() - t
+    times["lineup"] = lineups.total
+    if trace: profile.write_trace(trace)
+    t = time.perf_counter()
+    for system in systems: system.layout()
+    times["layout"] = time.perf_counter() - t
+    t = time.perf_counter()
+    for system in systems: system._pack_svg_list_ip(ctx)
+    times["pack"] = time.perf_counter() - t
+    t = time.perf_counter()
+    with tempfile.TemporaryDirectory() as tmp:
+        with E._svg_writer(os.path.join(tmp, "bench.svg"), (E.PAGEW, E.PAGEH), ctx) as writer:
+            for system in systems:
+                for elem in system._svg_list: writer.add(elem)
+    times["save"] = time.perf_counter() - t
+    return {"notes": notes, "systems": len(systems),
+            "objects": sum(len(E.members(s)) for s in systems),
+            "phases": times,
+            "rules": {f"{rt_name}:{order}:{stat['desc']}": stat 
+                      for (rt_name, order), stat in profile.by_rule().items()}}
+
+
+def measure(notes, seed=0, debug=False, trace=None):
+    """Like run, but repeats it until each phase has taken MIN_TIME in total or 
+    REPEAT_TIME is spent (at most MAX_REPEATS times) and averages the phases' times.
+    The rule stats and trace are of the first run."""
+    result = run(notes, seed, debug, trace)
+    totals = dict(result["phases"])
+    repeats = 1
+    while (min(totals.values()) < MIN_TIME and sum(totals.values()) < REPEAT_TIME 
+           and repeats < MAX_REPEATS):
+        for phase, t in run(notes, seed, debug)["phases"].items(): totals[phase] += t
+        repeats += 1
+    result["repeats"] = repeats
+    result["phases"] = {phase: t / repeats for phase, t in totals.items()}
+    return result
+
+
+def growth_exponents(results):
+    """The exponent k of t ~ n^k per phase, fitted (least squares in log-log) over the
+    sizes where the phase took at least MIN_TIME over all repetitions. Phases 
+    measured at less than two sizes are left out."""
+    exponents = {}
+    for phase in PHASES:
+        pts = [(math.log(r["notes"]), math.log(r["phases"][phase]))
+               for r in results if r["phases"][phase] * r.get("repeats", 1) >= MIN_TIME]
+        if len(pts) < 2: continue
+        mx = sum(x for x, _ in pts) / len(pts)
+        my = sum(y for _, y in pts) / len(pts)
+        sxx = sum((x - mx) ** 2 for x, _ in pts)
+        exponents[phase] = sum((x - mx) * (y - my) for x, y in pts) / sxx
+    return exponents
+
+
+def check(results, exponents, baseline=None):
+    """Returns the list of thresholds exceeded."""
+    failures = [f"{phase} grows with n^{k:.2f} (> n^{MAX_EXPONENT})"
+                for phase, k in exponents.items() if k > MAX_EXPONENT]
+    if baseline:
+        base = {r["notes"]: r["phases"] for r in baseline["results"]}
+        for r in results:
+            for phase, t in r["phases"].items():
+                b = base.get(r["notes"], {}).get(phase)
+                if b is not None and t * r.get("repeats", 1) >= MIN_TIME and t > b * TOLERANCE:
+                    failures.append(f"{phase} at {r['notes']} notes: {t:.3f}s, baseline {b:.3f}s")
+    return failures
+
+
+def _demerits(chunk_units, ends, width, lead_units, first_lead_units):
+    """The demerits of breaking chunk_units at ends, as cmn.break_lines counts them."""
+    total, start = 0, 0
+    for end in ends:
+        natural = sum(chunk_units[start:end]) + (first_lead_units if start == 0 else lead_units)
+        if end == len(chunk_units) and natural <= width: b = 0
+        else: 
+            b = cmn.line_badness(natural, width)
+            if b is None:
+                if end - start > 1: return math.inf
+                b = 100 * (natural / width) ** 3
+        total += (cmn.LINE_PENALTY + b) ** 2
+        start = end
+    return total
+
+
+def check_line_breaking(trials=BREAK_TRIALS, seed=0):
+    """Returns the failures of cmn.break_lines to find the least demerits of all 
+    possible breaks of random pieces."""
+    r = random.Random(seed)
+    failures = []
+    for trial in range(trials):
+        chunk_units = [r.choice(list(cmn.punct_units.values())) + r.choice((0, 0, 2, 4))
+                       for _ in range(r.randint(1, BREAK_CHUNKS))]
+        width, lead, first_lead = r.uniform(8, 40), r.choice((0, 4)), r.choice((0, 4, 8))
+        n = len(chunk_units)
+        best = min(_demerits(chunk_units, [*inner, n], width, lead, first_lead)
+                   for k in range(n) for inner in itertools.combinations(range(1, n), k))
+        found = _demerits(chunk_units, cmn.break_lines(chunk_units, width, lead, first_lead),
+                          width, lead, first_lead)
+        if not math.isclose(found, best, rel_tol=1e-9):
+            failures.append(f"line breaking trial {trial}: demerits {found}, least {best}")
+    return failures
+
+
+# Beaming cases: the time signature (num, denom) the content starts with if any, the
+# notes' durations, the meter and start position passed in and the group sizes expected.
+BEAM_CASES = (
+    ((4, 4), ["e"] * 8, (4, 4), 0, [2, 2, 2, 2]),
+    ((6, 8), ["e"] * 6, (4, 4), 0, [3, 3]),
+    ((3, 8), ["e"] * 6, (4, 4), 0, [3, 3]),
+    ((9, 8), ["e", "s", "s", "e"] + ["e"] * 6, (4, 4), 0, [4, 3, 3]),
+    ((12, 16), ["s"] * 12, (4, 4), 0, [3, 3, 3, 3]),
+    ((2, 2), ["e"] * 8, (4, 4), 0, [4, 4]),
+    # Systems without a time signature, starting mid-beat.
+    (None, ["e"] * 5, (6, 8), .125, [2, 3]),
+    (None, ["e"] * 5, (4, 4), .125, [2, 2]),
+)
+
+
+def check_beaming():
+    """Returns the groupings by cmn.beam_groups that differ from BEAM_CASES."""
+    failures = []
+    for timesig, durations, meter, start, expected in BEAM_CASES:
+        content = [S.SimpleTimeSig(*timesig)] if timesig else []
+        content += [S.Note(domain="treble", duration=d, pitch=["c", 4]) for d in durations]
+        found = [len(g) for g in cmn.beam_groups(content, meter, start)]
+        if found != expected:
+            failures.append(f"beaming {timesig or meter} {''.join(durations)}: groups {found}, "
+                            f"expected {expected}")
+    return failures
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Layout benchmarks for smt.")
+    parser.add_argument("sizes", nargs="*", type=int, default=SIZES, help="numbers of notes")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--debug", action="store_true", help="pack with svgwrite's validation")
+    parser.add_argument("--json", help="save the results to this file")
+    parser.add_argument("--baseline", help="compare to the results saved in this file")
+    parser.add_argument("--trace", help="save the rule applications of the largest score "
+                                        "as a Chrome trace to this file")
+    args = parser.parse_args(argv)
+    for rt in E._ruletables: rt.log = False
+    results = []
+    for notes in args.sizes:
+        r = measure(notes, args.seed, args.debug, 
+                    args.trace if notes == max(args.sizes) else None)
+        results.append(r)
+        print(f"{notes:>6} notes {r['objects']:>7} objects {r['repeats']:>4}x  " +
+              "  ".join(f"{phase} {t:.3f}" for phase, t in r["phases"].items()))
+    exponents = growth_exponents(results)
+    if exponents:
+        print("growth  " + "  ".join(f"{phase} n^{k:.2f}" for phase, k in exponents.items()))
+    baseline = None
+    if args.baseline:
+        with open(args.baseline) as file_: baseline = json.load(file_)
+    failures = (check(results, exponents, baseline) + check_line_breaking(seed=args.seed) 
+                + check_beaming())
+    for f in failures: print("FAIL", f)
+    if args.json:
+        with open(args.json, "w") as file_:
+            json.dump({"python": sys.version.split()[0], "seed": args.seed, "debug": args.debug,
+                       "thresholds": {"max_exponent": MAX_EXPONENT, "tolerance": TOLERANCE,
+                                      "min_time": MIN_TIME, "repeat_time": REPEAT_TIME},
+                       "results": results, "exponents": exponents, "failures": failures},
+                      file_, indent=2)
+    return 1 if failures else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,4 +1,5 @@
 from random import randint, choice
+import numpy as np
 import score as S
 import copy 
 
@@ -27,7 +28,9 @@ def make_notehead(note):
             "w": "noteheads.s0",
             "h": "noteheads.s1",
             "q": "noteheads.s2",
-            "8": "eight"
+            "8": "eight",
+            "e": "noteheads.s2",
+            "s": "noteheads.s2"
         }[note.duration])
     # elif isinstance(note.duration, (float, int)):
         # note.head_punch = S.E.MChar(name={
@@ -42,7 +45,7 @@ def isnote(x): return isinstance(x,S.Note)
 
 def isstem(o): return isinstance(o, S.Stem)
 def setstem(self):
-    if self.duration in (.25, .5, "q", "h", "8"):
+    if self.duration in (.25, .5, "q", "h", "8", "e", "s"):
         # self.stem_graver = S.E._LineSeg(x2=0, y2=10,thickness=2)
         s=S.Stem(length=15,thickness=1, 
         # color=S.E.SW.utils.rgb(0,50,0,"%"),
@@ -70,34 +73,35 @@ def setclef(clefobj):
 ############################# punctuation
 
 def decide_unit_dur(dur_counts):
+    """The rarest duration of dur_counts [(count, duration), ...], ties go to 
+    the shorter duration."""
     # return list(sorted(dur_counts.items()))[1][1]
-    return list(sorted(dur_counts, key=lambda l:l[0]))[0][1]
+    return min(dur_counts, key=lambda cd: (cd[0], punct_units[cd[1]], cd[1]))[1]
 
 punct_units = {"w":7, "h": 5, "q": 3.5,"8":3.5, "e": 2.5, "s": 2}
+# Whole notes per duration.
+dur_values = {"w": 1, "h": .5, "q": .25, "8": .125, "e": .125, "s": .0625}
 
 def ufactor(udur, dur2):
     return punct_units[dur2] / punct_units[udur]
     
-def compute_perf_punct(clocks, w):
+def compute_perf_punct(clocks, w, widths=None):
+    """Returns the space each of clocks gets in the width w, excluding the clock's own
+    width (widths, read from the clocks if not given). All durations are counted in 
+    one pass, the factors are looked up once per distinct duration."""
+    if not clocks: return []
     # notes=list(filter(lambda x:isinstance(x, Note), clocks))
-    durs=list(map(lambda x:x.duration, clocks))
-    dur_counts = []
-    for d in set(durs):
-        # dur_counts[durs.count(d)] =d
-        # dur_counts[d] =durs.count(d)
-        dur_counts.append((durs.count(d), d))
-    udur=decide_unit_dur(dur_counts)
-    uw=w / sum([x[0] * ufactor(udur, x[1]) for x in dur_counts])
-    perfwidths = []
-    for x in clocks:
-        # a space is excluding the own width of the clock (it's own char width)
-        space = ((uw * ufactor(udur, x.duration)) - x.width)
-        perfwidths.append(space)
-        # x.width += ((uw * ufactor(udur, x.duration)) - x.width)
-    return perfwidths
-
-def right_guard(obj):
-    return {S.Note: 2, S.Clef:3, S.Accidental: 2, S.SimpleTimeSig: 5}[type(obj)]
+    durs, inverse, counts = np.unique([x.duration for x in clocks], 
+                                      return_inverse=True, return_counts=True)
+    udur=decide_unit_dur(list(zip(counts.tolist(), durs.tolist())))
+    factors = np.array([ufactor(udur, d) for d in durs.tolist()])
+    uw=w / (counts * factors).sum()
+    if widths is None: widths = [x.width for x in clocks]
+    # a space is excluding the own width of the clock (it's own char width)
+    return (uw * factors[inverse] - np.asarray(widths, dtype=float)).tolist()
+
+_right_guards = {S.Note: 2, S.Clef:3, S.Accidental: 2, S.SimpleTimeSig: 5}
+def right_guard(obj): return _right_guards[type(obj)]
 def first_clock_idx(l):
     for i,x in enumerate(l):
         if isinstance(x, S.Clock):
@@ -111,6 +115,7 @@ def punctsys(h):
     for starting in startings:
         starting.width += right_guard(starting)
     clkchunks=S.clock_chunks(h.content[first_clock_idx_:])
+    if not clkchunks: return
     # print(clkchunks)
     clocks = list(map(lambda l:l[0], clkchunks))
     perfwidths = compute_perf_punct(clocks, h.width - sum([x.width for x in startings]))
@@ -135,6 +140,110 @@ def punctsys(h):
                     # a._width_locked = 1
     # h._lineup()
 
+############################# line breaking
+
+# Natural widths of non-clocks in punct units, other non-clocks take 2.
+nonclock_units = {S.Clef: 4, S.SimpleTimeSig: 4, S.Accidental: 2}
+# A line may be squeezed to this fraction of it's natural width at most.
+MIN_SQUEEZE = .75
+# Demerits of a line are (LINE_PENALTY + badness)², more lines cost more.
+LINE_PENALTY = 10
+
+def units(obj):
+    """Natural width of obj in punct units."""
+    if isinstance(obj, S.Clock): return punct_units[obj.duration]
+    return nonclock_units.get(type(obj), 2)
+
+def line_badness(natural, width):
+    """100|r|³ of setting a line of natural width in width, r being the stretch 
+    relative to the natural width (negative when squeezed). None if it doesn't fit."""
+    if natural * MIN_SQUEEZE > width: return None
+    return 100 * abs(width / natural - 1) ** 3
+
+def break_lines(chunk_units, width, lead_units=0, first_lead_units=0):
+    """
+    Total fit: returns the indices of chunk_units (the natural widths of the chunks) 
+    where lines end, minimizing the demerits of all lines together. Lines start
+    with lead_units, the first with first_lead_units. The last line may stay short.
+    The search back from a break ends at the first line too full (but for the first
+    line, if led by less), lines are short compared to the piece, so the cost is 
+    linear in the number of chunks.
+    """
+    n = len(chunk_units)
+    prefix = [0]
+    for u in chunk_units: prefix.append(prefix[-1] + u)
+    cost = [0] + [float("inf")] * n
+    prev = [0] * (n + 1)
+    for j in range(1, n + 1):
+        i = j - 1
+        while i >= 0:
+            natural = prefix[j] - prefix[i] + (first_lead_units if i == 0 else lead_units)
+            if j == n and natural <= width: b = 0
+            else: b = line_badness(natural, width)
+            if b is None:
+                if i < j - 1:
+                    # Only the first line, led by less, may still fit.
+                    if i > 0 and first_lead_units < lead_units:
+                        i = 0
+                        continue
+                    break
+                # A chunk too wide for any line gets a line of it's own.
+                b = 100 * (natural / width) ** 3
+            c = cost[i] + (LINE_PENALTY + b) ** 2
+            if c < cost[j]: cost[j], prev[j] = c, i
+            i -= 1
+    ends = []
+    j = n
+    while j > 0:
+        ends.append(j)
+        j = prev[j]
+    return ends[::-1]
+
+def make_systems(items, width, unit=None, startings=None, **kwargs):
+    """
+    Breaks the flat sequence items (clocks, each followed by it's non-clocks and
+    led by e.g. clef & time signature) into Systems of width (the last one is 
+    left at it's natural width if shorter). unit is the width of a punct unit, 
+    one staff space by default. startings, if given, is called for every system
+    but the first to return the objects it starts with, e.g. lambda: [S.Clef(pitch="g")].
+    Each System is given the meter and metric position it starts at. kwargs are 
+    passed to each System.
+    """
+    unit = unit or S.E.STAFF_SPACE
+    items = list(items)
+    first_clock_idx_ = first_clock_idx(items)
+    if first_clock_idx_ is None: return [System(items, width=width, **kwargs)]
+    lead = items[:first_clock_idx_]
+    chunks = S.clock_chunks(items[first_clock_idx_:])
+    chunk_units = [sum(map(units, c)) for c in chunks]
+    # Meter and whole notes since it's beginning where each chunk starts.
+    meter, pos = None, 0
+    for x in lead:
+        if istime(x): meter = (x.num, x.denom)
+    chunk_meters = []
+    for c in chunks:
+        chunk_meters.append((meter, pos))
+        for x in c:
+            if isinstance(x, S.Clock): pos += dur_values[x.duration]
+            elif istime(x): meter, pos = (x.num, x.denom), 0
+    next_startings = startings() if startings else []
+    ends = break_lines(chunk_units, width / unit, sum(map(units, next_startings)),
+                       sum(map(units, lead)))
+    systems = []
+    start = 0
+    for k, end in enumerate(ends):
+        if k == 0: content = lead
+        else:
+            content, next_startings = next_startings, startings() if startings and k < len(ends) - 1 else []
+        content = content + [x for c in chunks[start:end] for x in c]
+        w = width
+        if end == len(chunks):
+            w = min(width, unit * sum(map(units, content)))
+        meter, pos = chunk_meters[start]
+        systems.append(System(content, width=w, meter=meter, start=pos, **kwargs))
+        start = end
+    return systems
+
 
 def noteandtrebe(x): return isinstance(x, S.Note) and x.domain == "treble"
 def isacc(x): return isinstance(x, S.Accidental)
@@ -150,57 +259,107 @@ def ish(x): return isinstance(x, e.HForm)
 def isclef(x): return isinstance(x, S.Clef)
 def opachead(n): n.head_punch.opacity = .3
 
+class System(S.E.HForm):
+    """meter (num, denom) is the time signature in effect where the system starts,
+    start the whole notes since it's beginning (for systems broken off a longer
+    piece, see make_systems). Time signatures in the content take over from them."""
+    __slots__ = ("meter", "start")
+    def __init__(self, cnt, meter=None, start=0, **kw):
+        self.meter = meter
+        self.start = start
+        S.E.HForm.__init__(self, content=cnt, **kw)
+
 # Rules adding
 
-S.E.cmn.add(settime,istime,"Set Time...")
-S.E.cmn.add(make_notehead, noteandtrebe, "make noteheads")
-S.E.cmn.add(make_accidental_char, isacc, "Making Accidental Characters")
+S.E.cmn.add(settime, desc="Set Time...", type_=S.SimpleTimeSig)
+S.E.cmn.add(make_notehead, desc="make noteheads", type_=S.Note, domain="treble")
+S.E.cmn.add(make_accidental_char, desc="Making Accidental Characters", type_=S.Accidental)
 # e.cmn.add(greenhead, noteandtrebe)
-S.E.cmn.add(setstem, isnote, "Set stems")
-S.E.cmn.add(setclef, isclef, "Make clefs")
+S.E.cmn.add(setstem, desc="Set stems", type_=S.Note)
+S.E.cmn.add(setclef, desc="Make clefs", type_=S.Clef)
 # S.E.cmn.add(opachead, isnote)
-S.E.cmn.add(punctsys, isline, "Punctuate")
-
-
-def setbm(l):
-    o=[x for x in l.content if isnote(x) and x.duration in ("q","h")] #note mit openbeam
-    # c=[x for x in l.content if isnote(x) and x.close_beam][0]
-    # d=c.stem_graver.right -o.stem_graver.left
-    for a in o:
-        a.obeam_graver = S.E.HLineSeg(length=a.width,thickness=5,
-        x=a.left,
-        y=a.stem_graver.bottom,
-        # rotate=45,
-        )
-    # o.append(S.E.HLineSeg(length=o.width,thickness=5,x=o.left, y=o.stem_graver.bottom))
-    # c.append(S.E.HLineSeg(length=o.width,thickness=5,x=o.left, y=o.stem_graver.bottom))
-
-
-S.E.cmn.add(setbm, isline, "Set beams after Noten stehen fest (punctuation)")
-
-
-
-def addstaff(n):
-    # s=S.Staff()
-    # n.append(s)
-    # print(s.y)
-    # n.append(S.E.MultiHLineSeg(6, S.E.STAFF_SPACE, n.fixtop))
-    # m=S.E.MChar(name="m")
-    # n.append(m)
-    # n.append(S.E.HLineSeg(length=30, thickness=1, y=n.fixtop))
-    # print(m.x, m.y, n.x, n.y)
-    # print(n.FIXHEIGHT)
-    x=5
-    h=n.FIXHEIGHT / (x-1)
-    for i in range(x):
-        l=S.E.HLineSeg(length=n.width, thickness=1, y=i*h + n.top)
-        n.append(l)
-        # print(i)
-        
-        # n.append(e.HLineSeg(length=n.width, thickness=1, endxr=0))
-    # n._width_locked=1
-# print(S.E._glyph_names("haydn-11"))
-S.E.cmn.add(addstaff, isnote, "Draws stave.")
+S.E.cmn.add(punctsys, desc="Punctuate", type_=System)
+
+
+############################# beams
+
+# Beams per beamable duration.
+beam_levels = {"8": 1, "e": 1, "s": 2}
+BEAM_THICKNESS = 4
+BEAM_GAP = 3
+# Length of a partial beam, drawn for a note with more beams than its neighbours.
+BEAM_STUB = 6
+
+def meter_beat(num, denom):
+    """The beat of the meter num/denom in whole notes: dotted in compound meters
+    (6/8, 9/8, 12/16...), the whole bar in 3/8 and 3/16, otherwise 1/denom."""
+    if denom >= 8 and num % 3 == 0:
+        return (3 if num > 3 else num) / denom
+    return 1 / denom
+
+def beam_groups(content, meter=(4, 4), start=0):
+    """Splits the notes among content into groups of consecutive beamable notes
+    starting in the same beat of meter (num, denom), content starting start whole 
+    notes into the meter. Other clocks end a group, non-clocks are passed over, time 
+    signatures restart the count in their meter. Single notes are left out."""
+    groups, group, pos = [], [], start
+    beat = meter_beat(*meter)
+    for x in content:
+        if istime(x):
+            if len(group) > 1: groups.append(group)
+            group, pos, beat = [], 0, meter_beat(x.num, x.denom)
+            continue
+        if not isinstance(x, S.Clock): continue
+        beamable = isnote(x) and x.duration in beam_levels
+        if not beamable or (group and pos // beat != group_beat):
+            if len(group) > 1: groups.append(group)
+            group = []
+        if beamable:
+            if not group: group_beat = pos // beat
+            group.append(x)
+        pos += dur_values[x.duration]
+    if len(group) > 1: groups.append(group)
+    return groups
+
+def make_beams(group):
+    """Returns the beams of group, one per run of notes sharing a level. All levels
+    are flat at the lowest stem end, the stems are extended to reach them."""
+    stems = [n.stem_graver for n in group]
+    base = max(st.bottom for st in stems)
+    for st in stems:
+        if st.bottom < base: st.length += base - st.bottom
+    beams = []
+    for level in range(1, max(beam_levels[n.duration] for n in group) + 1):
+        y = base - BEAM_THICKNESS / 2 - (level - 1) * (BEAM_THICKNESS + BEAM_GAP)
+        i = 0
+        while i < len(group):
+            if beam_levels[group[i].duration] < level:
+                i += 1
+                continue
+            j = i
+            while j + 1 < len(group) and beam_levels[group[j + 1].duration] >= level: j += 1
+            if j > i:
+                left, right = stems[i].left, stems[j].right
+            elif i: # Stub to the left, unless first of the group.
+                left, right = stems[i].right - BEAM_STUB, stems[i].right
+            else:
+                left, right = stems[i].left, stems[i].left + BEAM_STUB
+            beams.append(S.Beam(group[i:j + 1], level, length=right - left, 
+                                thickness=BEAM_THICKNESS, x=left, y=y))
+            i = j + 1
+    return beams
+
+def setbeams(line):
+    beams = [b for g in beam_groups(line.content, line.meter or (4, 4), line.start) 
+             for b in make_beams(g)]
+    if beams: line.append(*beams)
+S.E.cmn.add(setbeams, desc="Beams notes by beat after punctuation", type_=System)
+
+
+
+def addstaff(line):
+    line.append(S.Staff(length=line.width, x=line.left, y=line.y))
+S.E.cmn.add(addstaff, desc="Draws the staff across the system once punctuated.", type_=System)
 
 def skew(staff):
     print(staff.skewx)
@@ -240,9 +399,6 @@ def flag(note):
 # Accidental(domain="treble",pitch=["d",4])
 # ]
 
-class System(S.E.HForm):
-    def __init__(self, cnt, **kw):
-        S.E.HForm.__init__(self, content=cnt, **kw)
 # s=SForm(width=5,width_locked=0,x=50)
 # s.append(Stem(length=10,thickness=30))
 # h=HForm(content=[s],width=mmtopx(20),x=40,y=200, canvas_opacity=.2, width_locked=0)
@@ -4,31 +4,109 @@ Semantic Music Typesetting
 """
 
 import tempfile
+import io
 import json
+import logging
+import time
+import weakref
+import re
 import os
+import mmap
+import struct
+import contextlib
+import multiprocessing
 import xml.etree.ElementTree as ET
 import subprocess as sp
 import copy as cp
 import svgwrite as SW
 import svgelements as SE
-import svgpathtools as SPT
-from math import atan2, hypot
+import numpy as np
+from math import atan2, hypot, sin, cos, tan, radians
+
+_log = logging.getLogger(__name__)
 
 
 ##### Font
 
+# Font directories are laid out like ./fonts: json/ holds the installed fonts, bin/ their
+# compiled versions. Directories from SMT_FONT_PATH (separated by os.pathsep) are searched
+# before the fonts shipped with smt. SMT_FONT_CACHE names a directory of compiled fonts
+# which is consulted before everything else, e.g. a cache shared read-only by many processes.
+_PACKAGE_FONTS = os.path.join(os.path.dirname(os.path.abspath(__file__)), "fonts")
+_font_dirs = [os.path.abspath(p) for p in os.environ.get("SMT_FONT_PATH", "").split(os.pathsep) if p]
+_font_dirs.append(_PACKAGE_FONTS)
+_font_cache = os.environ.get("SMT_FONT_CACHE") or None
+
+def font_dirs(): return list(_font_dirs)
+
+def add_font_dir(path, first=True):
+    """Adds path to the directories searched for fonts, by default with the 
+    highest priority."""
+    path = os.path.abspath(path)
+    if path in _font_dirs: _font_dirs.remove(path)
+    if first: _font_dirs.insert(0, path)
+    else: _font_dirs.append(path)
+    _fonts_changed()
+
+def font_cache(): return _font_cache
+
+def set_font_cache(path):
+    """Compiled fonts are looked up in path before the font directories. Fonts 
+    missing there are compiled into it if it is writable. None disables the cache."""
+    global _font_cache
+    _font_cache = path and os.path.abspath(path)
+    _fonts_changed()
+
+def precompile_fonts(path=None):
+    """Compiles all installed fonts into path (defaults to the font cache), 
+    to be used as a shared font cache."""
+    path = path or _font_cache
+    if not path:
+        raise ValueError("No path given and no font cache set (see set_font_cache).")
+    os.makedirs(path, exist_ok=True)
+    for name in installed_fonts():
+        font = _font(name)
+        _compile_font({g: font[g] for g in font.keys()}, os.path.join(path, f"{name}.smtf"))
+
+def _fonts_changed():
+    """Forgets everything resolved with the old font settings."""
+    global _default_font_name
+    _default_font_name = None
+    _loaded_fonts.clear()
+    _glyph_cubics.clear()
+    _glyph_bboxes.clear()
+
+def _compile_font_into(glyphs, name, fontdir):
+    """Compiles the glyphs into the font cache, or if that is not possible into 
+    fontdir's bin/. Returns the path written or None if nothing could be written."""
+    targets = [os.path.join(fontdir, "bin", f"{name}.smtf")]
+    if _font_cache: targets.insert(0, os.path.join(_font_cache, f"{name}.smtf"))
+    for target in targets:
+        try:
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            _compile_font(glyphs, target)
+            return target
+        except OSError:
+            pass
+
+
 _SVGNS = {"ns": "http://www.w3.org/2000/svg"}
 # _fontsdict = {}
 # installed_fonts = []
-def install_font1(path, overwrite=False):
+def install_font1(path, overwrite=False, fontdir=None):
+    """Converts the svg font at path to json and compiles it for fast loading.
+    The font is installed into fontdir, by default the first font directory."""
+    fontdir = fontdir or _font_dirs[0]
     name, ext = os.path.splitext(os.path.basename(path))
-    if os.path.exists(f"./fonts/json/{name}.json") and not overwrite:
+    jsonpath = os.path.join(fontdir, "json", f"{name}.json")
+    if os.path.exists(jsonpath) and not overwrite:
         raise FileExistsError(f"{name} is already installed.")
     else:
         D = {}
         D[name] = {}
         if ext == ".svg":
-            with open(f"./fonts/json/{name}.json", "w") as file_:
+            os.makedirs(os.path.dirname(jsonpath), exist_ok=True)
+            with open(jsonpath, "w") as file_:
                 font = ET.parse(path).getroot().find("ns:defs", _SVGNS).find("ns:font", _SVGNS)
                 for glyph in font.findall("ns:glyph", _SVGNS):
                     try:
@@ -50,26 +128,223 @@ def install_font1(path, overwrite=False):
                 json.dump(D[name], file_, indent=2)
                 del path
                 del glyph
+            _compile_font_into(D[name], name, fontdir)
+            _fonts_changed()
         else:
             raise NotImplementedError("Non-svg fonts are not supported!")
 
-_loaded_fonts = {}
 
-def _load_fonts():
-    for json_file in os.listdir("./fonts/json"):        
-        with open(f"./fonts/json/{json_file}") as font:
-            _loaded_fonts[os.path.splitext(json_file)[0]] = json.load(font)
+# Compiled fonts: a header, a table of fixed-size glyph records sorted by glyph name
+# and a blob of the names & d strings the records point to. Records hold
+# (name offset, name length, d offset, d length, left, right, top, bottom, width, height).
+_SMTF_MAGIC = b"SMTF"
+_SMTF_VERSION = 1
+_SMTF_HEADER = struct.Struct("<4sHI")
+_SMTF_RECORD = struct.Struct("<IHII6d")
+_GLYPH_METRICS = ("left", "right", "top", "bottom", "width", "height")
+
+def _compile_font(glyphs, path):
+    """Writes the glyphs dictionary (as found in the json files) to path."""
+    names = sorted(glyphs, key=lambda n: n.encode())
+    records = []
+    blob = bytearray()
+    blob_start = _SMTF_HEADER.size + len(names) * _SMTF_RECORD.size
+    for name in names:
+        bname = name.encode()
+        bd = glyphs[name]["d"].encode()
+        name_off = blob_start + len(blob)
+        records.append(_SMTF_RECORD.pack(name_off, len(bname), name_off + len(bname), len(bd),
+                                         *[glyphs[name][m] for m in _GLYPH_METRICS]))
+        blob += bname + bd
+    # Write to a temporary file first, other processes might be reading path.
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, "wb") as file_:
+        file_.write(_SMTF_HEADER.pack(_SMTF_MAGIC, _SMTF_VERSION, len(names)))
+        file_.write(b"".join(records))
+        file_.write(blob)
+    os.replace(tmp, path)
+
+
+class _CompiledFont:
+    """Read-only, memory-mapped view of a compiled font. Glyphs are looked up
+    by bisecting the sorted records and decoded only on their first access."""
+    
+    def __init__(self, path):
+        with open(path, "rb") as file_:
+            self._buf = mmap.mmap(file_.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, self._count = _SMTF_HEADER.unpack_from(self._buf)
+        if magic != _SMTF_MAGIC or version != _SMTF_VERSION:
+            raise ValueError(f"{path} is not a compiled font of version {_SMTF_VERSION}.")
+        self._glyphs = {}
+    
+    def _record(self, i):
+        return _SMTF_RECORD.unpack_from(self._buf, _SMTF_HEADER.size + i * _SMTF_RECORD.size)
+    
+    def _name(self, i):
+        name_off, name_len = self._record(i)[:2]
+        return self._buf[name_off:name_off + name_len]
+    
+    def _index(self, name):
+        bname = name.encode()
+        lo, hi = 0, self._count
+        while lo < hi:
+            mid = (lo + hi) // 2
+            if self._name(mid) < bname: lo = mid + 1
+            else: hi = mid
+        if lo < self._count and self._name(lo) == bname:
+            return lo
+    
+    def __getitem__(self, name):
+        try:
+            return self._glyphs[name]
+        except KeyError:
+            i = self._index(name)
+            if i is None: raise
+            _, _, d_off, d_len, *metrics = self._record(i)
+            glyph = self._glyphs[name] = {"d": self._buf[d_off:d_off + d_len].decode(),
+                                          **dict(zip(_GLYPH_METRICS, metrics))}
+            return glyph
+    
+    def __contains__(self, name): return self._index(name) is not None
+    def __len__(self): return self._count
+    def __iter__(self): return iter(self.keys())
+    def keys(self): return [self._name(i).decode() for i in range(self._count)]
 
 
-# install_font1("./fonts/svg/haydn-11.svg",1)
-_load_fonts()
+# Fonts are loaded on their first use.
+_loaded_fonts = {}
+
+def installed_fonts():
+    """Returns the names of all installed fonts without loading them."""
+    places = [(os.path.join(d, sub), ext) for d in _font_dirs
+              for sub, ext in (("json", ".json"), ("bin", ".smtf"))]
+    if _font_cache: places.append((_font_cache, ".smtf"))
+    names = set()
+    for dir_, ext in places:
+        if os.path.isdir(dir_):
+            names.update(os.path.splitext(f)[0] for f in os.listdir(dir_) if f.endswith(ext))
+    return sorted(names)
+
+def _load_font(name):
+    """Returns the compiled font. A font in the font cache is used as is, otherwise
+    the first font directory having the font decides: it's json is (re)compiled
+    if the compiled font is missing or older. If the compiled font can't be 
+    written the json glyphs are returned."""
+    if _font_cache:
+        cached = os.path.join(_font_cache, f"{name}.smtf")
+        if os.path.exists(cached): return _CompiledFont(cached)
+    for fontdir in _font_dirs:
+        jsonpath = os.path.join(fontdir, "json", f"{name}.json")
+        binpath = os.path.join(fontdir, "bin", f"{name}.smtf")
+        if os.path.exists(jsonpath):
+            if os.path.exists(binpath) and os.path.getmtime(binpath) >= os.path.getmtime(jsonpath):
+                return _CompiledFont(binpath)
+            with open(jsonpath) as font:
+                glyphs = json.load(font)
+            compiled = _compile_font_into(glyphs, name, fontdir)
+            return _CompiledFont(compiled) if compiled else glyphs
+        if os.path.exists(binpath): return _CompiledFont(binpath)
+    raise KeyError(f"Font {name} is not installed.")
+
+def _font(name):
+    try:
+        return _loaded_fonts[name]
+    except KeyError:
+        font = _loaded_fonts[name] = _load_font(name)
+        return font
+
+_default_font_name = None
+
+def _default_font():
+    global _default_font_name
+    if _default_font_name is None:
+        _default_font_name = installed_fonts()[0]
+    return _default_font_name
+
+# install_font1(os.path.join(_PACKAGE_FONTS, "svg", "haydn-11.svg"), 1)
 
 def glyph_names(font):
-    return _loaded_fonts[font].keys()
+    return _font(font).keys()
 
-def _get_glyph(name, font): return _loaded_fonts[font][name]
+def _get_glyph(name, font): return _font(font)[name]
 # print(_loaded_fonts)
 
+# Outlines of glyphs as cubic bezier control points (n, 4, 2), keyed by (font, name).
+_glyph_cubics = {}
+# Bboxes of glyphs transformed at the origin, keyed by (font, name, matrix).
+_glyph_bboxes = {}
+
+def _glyph_curves(name, font):
+    """Returns the outline of the glyph as an array of cubic beziers, lines and
+    quadratic beziers are expressed as (degenerate) cubics. Parsed once per glyph."""
+    key = (font, name)
+    try:
+        return _glyph_cubics[key]
+    except KeyError:
+        curves = []
+        for seg in SE.Path(_get_glyph(name, font)["d"]):
+            if isinstance(seg, SE.Move) or seg.start is None: continue
+            if isinstance(seg, SE.CubicBezier):
+                curves.append((seg.start, seg.control1, seg.control2, seg.end))
+            elif isinstance(seg, SE.QuadraticBezier):
+                p0, p1, p2 = seg.start, seg.control, seg.end
+                curves.append((p0, p0 + (p1 - p0) * (2/3), p2 + (p1 - p2) * (2/3), p2))
+            elif isinstance(seg, SE.Arc):
+                curves.extend((c.start, c.control1, c.control2, c.end) for c in seg.as_cubic_curves())
+            else: # Line, Close
+                curves.append((seg.start, seg.start, seg.end, seg.end))
+        cubics = _glyph_cubics[key] = np.array(curves, dtype=float).reshape(-1, 4, 2)
+        return cubics
+
+def _cubics_bbox(P):
+    """The exact bbox (xmin, xmax, ymin, ymax) of the cubic beziers P (n, 4, 2): the 
+    extremes are among the end points and the roots of the derivative."""
+    p0, p1, p2, p3 = P[:, 0], P[:, 1], P[:, 2], P[:, 3]
+    # B'(t) / 3 = a t² + b t + c, per coordinate.
+    a = p3 - 3 * p2 + 3 * p1 - p0
+    b = 2 * (p2 - 2 * p1 + p0)
+    c = p1 - p0
+    with np.errstate(divide="ignore", invalid="ignore"):
+        sq = np.sqrt(b * b - 4 * a * c)
+        quadratic = np.abs(a) > 1e-12 * (np.abs(b) + np.abs(c))
+        t1 = np.where(quadratic, (-b + sq) / (2 * a), -c / b)
+        t2 = np.where(quadratic, (-b - sq) / (2 * a), np.nan)
+    t = np.stack([np.zeros_like(t1), np.ones_like(t1), t1, t2], axis=-1)
+    # Roots outside the curve (and nans) are replaced by its start.
+    t = np.where((t >= 0) & (t <= 1), t, 0)
+    u = 1 - t
+    B = (u**3 * p0[..., None] + 3 * u**2 * t * p1[..., None] + 
+         3 * u * t**2 * p2[..., None] + t**3 * p3[..., None])
+    return B[:, 0].min(), B[:, 0].max(), B[:, 1].min(), B[:, 1].max()
+
+def _glyph_bbox(name, font, matrix):
+    """Returns the bbox (xmin, xmax, ymin, ymax) of the glyph transformed by matrix 
+    (a, b, c, d), sitting at the origin. Every combination is computed only once."""
+    key = (font, name, matrix)
+    try:
+        return _glyph_bboxes[key]
+    except KeyError:
+        a, b, c, d = matrix
+        P = _glyph_curves(name, font) @ np.array([[a, b], [c, d]])
+        bbox = _glyph_bboxes[key] = tuple(float(v) for v in _cubics_bbox(P))
+        return bbox
+
+def _affine(xscale, yscale, skewx, skewy, rotate):
+    """The linear part (a, b, c, d) of svg's matrix(a b c d e f) for rotate(rotate),
+    then svgelements' combined skew(skewx, skewy), i.e. [[1, tan skewx], [tan skewy, 1]]
+    (unlike skewX(skewx) skewY(skewy) without a tan skewx * tan skewy term), then 
+    scale(xscale, yscale). Angles in degrees."""
+    tx, ty = tan(radians(skewx)), tan(radians(skewy))
+    cos_, sin_ = cos(radians(rotate)), sin(radians(rotate))
+    return ((cos_ - sin_ * ty) * xscale, (sin_ + cos_ * ty) * xscale,
+            (cos_ * tx - sin_) * yscale, (sin_ * tx + cos_) * yscale)
+
+def _bboxpath_d(xmin, xmax, ymin, ymax):
+    """The d of a closed path around the bbox, same as svgpathtools' bbox2path."""
+    xmin, xmax, ymin, ymax = float(xmin), float(xmax), float(ymin), float(ymax)
+    return (f"M {xmin},{ymin} L {xmax},{ymin} L {xmax},{ymax} "
+            f"L {xmin},{ymax} L {xmin},{ymin}")
+
 
 # ################################
 # _fonts = {}
@@ -111,28 +386,48 @@ def toplevel_scale(R): return R * _scale()
 _LEFT_MARGIN = mmtopx(36)
 _TOP_MARGIN = mmtopx(56)
 
+# Lazy layout: changing the geometry of an object only marks it's ancestors as
+# outdated, forms recompute their extents once when they are read next (or by 
+# layout()). Eager layout recomputes all ancestors on every single change.
+LAZY_LAYOUT = True
 
+# Forms waiting to be lined up, one dict (used as ordered set) per open batch_layout block.
+_layout_batches = []
 
-# ~ Why am I not writing this as a method to FORM?
-def _descendants(obj, N, D):
-    if isinstance(obj, _Form) and obj.content:
-        if N not in D:
-            # ~ Shallow copy only the outer content List,
-            D[N] = cp.copy(obj.content)
-        else:
-            D[N].extend(obj.content)
-        for C in obj.content:
-            _descendants(C, N+1, D)
-    return D
-    
+@contextlib.contextmanager
+def batch_layout():
+    """Defers lining up forms until the end of the block. Forms whose content has
+    changed inside the block are lined up once on exit, the innermost forms first."""
+    batch = {}
+    _layout_batches.append(batch)
+    try:
+        yield batch
+    finally:
+        _layout_batches.pop()
+    for form in sorted(batch, key=lambda F: len(F.ancestors), reverse=True):
+        form._lineup()
+
+def _lineup_later(form):
+    """Lines up form now, or at the end of the current batch_layout block."""
+    if _layout_batches: _layout_batches[-1][form] = None
+    else: form._lineup()
+
+
+
+# Forms cache their descendants by generation, see _Form._generations.
 def descendants(obj, lastgen_first=True):
-    D = []
-    for _, gen in sorted(_descendants(obj, 0, {}).items(), reverse=lastgen_first):
-        D.extend(gen)
-    return D
+    if not isinstance(obj, _Form): return []
+    gens = obj._generations()
+    return [D for gen in (reversed(gens) if lastgen_first else gens) for D in gen]
 
 
-def members(obj): return [obj] + descendants(obj, lastgen_first=False)
+def members(obj):
+    """Returns obj and all of it's descendants, generation by generation.
+    The list of a form is cached until it's structure changes, don't modify it!"""
+    if not isinstance(obj, _Form): return [obj]
+    if obj._members is None:
+        obj._members = [obj] + descendants(obj, lastgen_first=False)
+    return obj._members
 
 def getallin(typeof, obj):
     """Returns an iterable of all types in obj."""
@@ -142,9 +437,9 @@ def getallin(typeof, obj):
 ############# Rules
 _ruletables = set()
 
-def _pending_ruletables():
-    """True if there some ruletables with pending rules."""
-    return [rt for rt in _ruletables if rt._pending()]
+def _pending_ruletables(applied):
+    """Returns the ruletables with rules pending, i.e. not in applied."""
+    return [rt for rt in _ruletables if rt._pending(applied)]
 
 class RuleTable:
     
@@ -152,63 +447,228 @@ class RuleTable:
         self.name = name
         self.rules = dict()
         self._order = 0
-        self.log = True # Print rules as they are being applied.
+        self.log = True # Log rules (at INFO level) as they are being applied.
         self._hook_registry = []
         self._pred_registry = []
         _ruletables.add(self)
     # def __repr__(self): return f"RuleTable {self.id}"
-    def _pending(self):
+    def _pending(self, applied):
         """Returns a list of rules of this ruletable: (order, rule-dictionary)
-        which are pending for application. If nothing is pending 
-        [] is returned."""
+        which are pending for application, i.e. (ruletable, order) is not in applied.
+        If nothing is pending [] is returned."""
         # o=order, rd=rule dict
-        return [(o, rd) for (o, rd) in self.rules.items() if not rd["applied"]]
+        return [(o, rd) for (o, rd) in self.rules.items() if (self, o) not in applied]
     
-    def add(self, hook, pred, desc=None):
+    def add(self, hook, pred=None, desc=None, type_=None, domain=None):
         """
         Rule will be added only if at least one of hook or predicate are fresh.
+        type_ and domain select the objects the rule is tried on (isinstance of type_
+        and having domain), pred is then called only on these candidates. 
+        Selected rules are dispatched from an index instead of testing all members.
         """
+        select = None
+        if type_ is not None or domain is not None:
+            select = (type_ or _SMTObject, domain)
         hhash = hook.__hash__()
-        phash = pred.__hash__()
+        phash = (pred, select).__hash__()
         if hhash not in self._hook_registry or phash not in self._pred_registry:
-            self.rules[self._order] = {"desc": desc, "hook": hook, "pred": pred, "applied": False}
+            self.rules[self._order] = {"desc": desc, "hook": hook, "pred": pred, 
+                                       "select": select}
             self._order += 1
             self._hook_registry.append(hhash)
             self._pred_registry.append(phash)
             
     def __len__(self): return len(self.rules)
+    
+    # Ruletables are pickled by name (e.g. along with objects sent to worker processes)
+    # and resolve to the table of the same name in the unpickling process.
+    def __reduce__(self): return (_ruletable_named, (self.name,))
+
+def _ruletable_named(name):
+    for rt in _ruletables:
+        if rt.name == name: return rt
+    raise KeyError(f"No ruletable named {name}.")
+
+
+def _index_members(members_, selectors):
+    """Sorts members_ into lists of candidates per selector (type, domain) in a single
+    pass, keeping the members' order. Classes are matched against the selectors once."""
+    index = {sel: [] for sel in selectors}
+    matching = {}
+    for m in members_:
+        cls = m.__class__
+        if cls not in matching:
+            matching[cls] = [sel for sel in selectors if issubclass(cls, sel[0])]
+        for sel in matching[cls]:
+            if sel[1] is None or m.domain == sel[1]:
+                index[sel].append(m)
+    return index
+
+
+class RuleProfile:
+    """
+    What applying rules has cost, recorded by profile_rules. stats maps 
+    (ruletable name, order, depth) to a dict of the rule's desc and
+    time: wall time in seconds, including lining up after the rule
+    candidates: objects the rule has visited
+    predicates: predicate calls
+    hooks: hook calls, i.e. the predicate's hits
+    relayouts: forms lined up after the rule
+    """
+    FIELDS = ("time", "candidates", "predicates", "hooks", "relayouts")
+    
+    def __init__(self):
+        self.stats = {}
+        # Chrome trace events, see write_trace.
+        self._events = []
+        self._t0 = time.perf_counter()
+    
+    def _record(self, rt, order, depth, desc, start, values):
+        key = (rt.name, order, depth)
+        stat = self.stats.setdefault(key, dict(desc=desc, **dict.fromkeys(self.FIELDS, 0)))
+        for field, v in zip(self.FIELDS, values): stat[field] += v
+        self._events.append({"name": desc or f"{rt.name} {order}", "cat": rt.name, "ph": "X",
+                             "ts": (start - self._t0) * 1e6, "dur": values[0] * 1e6,
+                             "pid": os.getpid(), "tid": 0,
+                             "args": dict(order=order, depth=depth, **dict(zip(self.FIELDS[1:], values[1:])))})
+    
+    def by_rule(self):
+        """The stats summed over all depths, keyed by (ruletable name, order)."""
+        rules = {}
+        for (rt_name, order, _), stat in self.stats.items():
+            r = rules.setdefault((rt_name, order), dict(desc=stat["desc"], **dict.fromkeys(self.FIELDS, 0)))
+            for field in self.FIELDS: r[field] += stat[field]
+        return rules
+    
+    def report(self):
+        """A table of the stats, most expensive rules first."""
+        lines = [f"{'time':>9} {'cands':>7} {'preds':>7} {'hooks':>7} {'relay':>6}  depth rule"]
+        for (rt_name, order, depth), st in sorted(self.stats.items(), key=lambda kv: -kv[1]["time"]):
+            lines.append(f"{st['time']:9.4f} {st['candidates']:7} {st['predicates']:7} {st['hooks']:7} "
+                         f"{st['relayouts']:6}  {depth:5} {rt_name} {order}: {st['desc']}")
+        return "\n".join(lines)
+    
+    def __str__(self): return self.report()
+    
+    def write_trace(self, path):
+        """Saves the rule applications in Chrome's trace event format, viewable in
+        chrome://tracing or Perfetto."""
+        with open(path, "w") as file_:
+            json.dump({"traceEvents": self._events, "displayTimeUnit": "ms"}, file_)
+
+# The RuleProfile being recorded, None if not profiling.
+_rule_profile = None
+
+@contextlib.contextmanager
+def profile_rules():
+    """Records the rule applications inside the block into the RuleProfile yielded."""
+    global _rule_profile
+    outer, _rule_profile = _rule_profile, RuleProfile()
+    try:
+        yield _rule_profile
+    finally:
+        _rule_profile = outer
 
 
 # Common Music Notation, default ruletable for all objects
 cmn = RuleTable(name="CMN")
-_registry = {}
-def getbyid(id_): return _registry[id_]
+
+class Document:
+    """
+    The scope objects are created in. Ids are counted per document, each class
+    starting at it's _idcounter, so the same score gets the same ids in every 
+    document. The registry only references objects weakly: dropped objects (and 
+    scores) are released. Objects are created in the current document, a 
+    document is made current inside a with block, otherwise the default one is.
+    id_prefix is prepended to the ids assigned, e.g. to keep ids of objects 
+    created in different processes apart.
+    """
+    def __init__(self, id_prefix=""):
+        self.id_prefix = id_prefix
+        self.registry = weakref.WeakValueDictionary()
+        self._idcounters = {}
+        self._outer = []
+    
+    def _assign_id(self, cls):
+        n = self._idcounters.get(cls, cls._idcounter)
+        self._idcounters[cls] = n + 1
+        return f"{self.id_prefix}{cls.__name__}{n}"
+    
+    def _register(self, obj): self.registry[obj.id] = obj
+    
+    def getbyid(self, id_): return self.registry[id_]
+    
+    def __enter__(self):
+        global _document
+        self._outer.append(_document)
+        _document = self
+        return self
+    
+    def __exit__(self, *exc):
+        global _document
+        _document = self._outer.pop()
+
+_document = _default_document = Document()
+
+def current_document(): return _document
+def getbyid(id_): return _document.getbyid(id_)
 class _SMTObject:
+    # Score objects come in thousands, they are slotted all the way down. Mixins 
+    # have empty slots, classes using them declare their attributes.
+    __slots__ = ("toplevel", "_parent", "id", "_svg_list", "domain", "ruletable", 
+                 "_applied_rules", "__weakref__")
     def __init__(self, id_=None, domain=None, ruletable=None, toplevel=False):
         self.toplevel = toplevel
-        self.ancestors = []
+        # Only the parent is known, ancestry is walked up on demand.
+        self._parent = None
         self.id = id_ or self._assign_id()
-        self._svg_list = []
+        # Elements added by addsvg, shared empty tuple until then.
+        self._svg_list = ()
         self.domain = domain
         self.ruletable = ruletable or cmn
-        _registry[self.id] = self
+        # Rules applied to us as the root of a rule application: {(ruletable, order), ...}
+        self._applied_rules = None
+        _document._register(self)
 
-    def _pack_svg_list_ip(self): self._notimplemented("_pack_svg_list_ip")
+    def _svg_elements(self, ctx):
+        """Yields our svg elements (and those of our content) one by one. ctx is
+        the _RenderContext of the render."""
+        self._notimplemented("_svg_elements")
+
+    def _pack_svg_list_ip(self, ctx=None):
+        self._svg_list = list(self._svg_elements(ctx or _RenderContext()))
     
     def _notimplemented(self, method_name):
         """Crashs if the derived class hasn't implemented this important method."""
         raise NotImplementedError(f"{self.__class__.__name__} must override {method_name}!")
     
-    def _assign_id(self):
-        id_ = f"{self.__class__.__name__}{self.__class__._idcounter}"
-        self.__class__._idcounter += 1
-        return id_
+    def __setstate__(self, state):
+        # Slotted objects are pickled as (None, {slot: value}).
+        if isinstance(state, tuple): state = {**(state[0] or {}), **state[1]}
+        for name, value in state.items(): object.__setattr__(self, name, value)
+    
+    def _assign_id(self): return _document._assign_id(self.__class__)
 
     def addsvg(self, *elements):
-        self._svg_list.extend(elements)
+        self._svg_list = [*self._svg_list, *elements]
 
-    def parent(self): return self.ancestors[-1]
-    def root(self): return self.ancestors[0]
+    def parent(self): return self._parent
+    def root(self):
+        obj = self
+        while obj._parent is not None: obj = obj._parent
+        return obj
+    
+    def _iter_ancestors(self):
+        """Yields the ancestors, starting with the parent."""
+        a = self._parent
+        while a is not None:
+            yield a
+            a = a._parent
+    
+    @property
+    def ancestors(self):
+        """List of the ancestors, starting with the root."""
+        return list(self._iter_ancestors())[::-1]
     
     def _apply_rules(self):
         """
@@ -216,27 +676,57 @@ class _SMTObject:
         A rule will look for application-targets exactly once per each 
         rule-application iteration. This means however that a rule might be applied
         to an object more than once, if the object satisfies it's condition.
+        Which rules have been applied is remembered by self: applying rules again 
+        only applies rules added since, and other objects start afresh.
         """
+        if self._applied_rules is None: self._applied_rules = set()
+        applied = self._applied_rules
+        profile = _rule_profile
         depth = -1
         while True:
-            pending_rts = _pending_ruletables()
+            pending_rts = _pending_ruletables(applied)
             if pending_rts:
                 depth += 1
+                # Candidates of all selecting rules are indexed together, the index is 
+                # rebuilt only when the members have changed.
+                selectors = {rule["select"] for rt in pending_rts for _, rule in rt._pending(applied)}
+                selectors.discard(None)
+                index, indexed = None, None
                 for rt in pending_rts:
                     # o_rd=(order, ruledictionary), sort pending rules based on their order.
-                    for order, rule in sorted(rt._pending(), key=lambda o_rd: o_rd[0]):
-                        if rt.log:
-                            print(f"RT: {rt.name}, Depth: {depth}, Order: {order}, Desc: {rule['desc']}")
+                    for order, rule in sorted(rt._pending(applied), key=lambda o_rd: o_rd[0]):
+                        if rt.log and _log.isEnabledFor(logging.INFO):
+                            _log.info("RT: %s, Depth: %s, Order: %s, Desc: %s", 
+                                      rt.name, depth, order, rule["desc"])
+                        if profile is not None: start = time.perf_counter()
                         # get in each round the up-to-date list of members (possibly new objects have been added etc....)
-                        for m in members(self):
-                            if rule["pred"](m):
-                                rule["hook"](m)
-                                if isinstance(m, HForm): m._lineup() # Das untenstehende scheint sinvoller??!
-                                # for a in reversed(m.ancestors):
-                                    # if isinstance(a, HForm): a._lineup()
+                        candidates = members(self)
+                        if rule["select"] is not None:
+                            if indexed is not candidates or rule["select"] not in index:
+                                selectors.add(rule["select"])
+                                index, indexed = _index_members(candidates, selectors), candidates
+                            candidates = index[rule["select"]]
+                        # Hooks' appends are laid out together after the rule.
+                        hooks = 0
+                        with batch_layout() as batch:
+                            for m in candidates:
+                                if rule["pred"] is None or rule["pred"](m):
+                                    hooks += 1
+                                    rule["hook"](m)
+                                    if isinstance(m, HForm): _lineup_later(m) # Das untenstehende scheint sinvoller??!
+                                    # for a in reversed(m.ancestors):
+                                        # if isinstance(a, HForm): a._lineup()
+                            # The geometry of the line segments the rule has added, in one 
+                            # batch before the lineups read it.
+                            _prepare_linesegs(members(self))
                         # A rule is applied not more than once!
-                        rule["applied"] = True
-                pending_rts = _pending_ruletables()
+                        applied.add((rt, order))
+                        if profile is not None:
+                            profile._record(rt, order, depth, rule["desc"], start,
+                                            (time.perf_counter() - start, len(candidates),
+                                             0 if rule["pred"] is None else len(candidates),
+                                             hooks, len(batch)))
+                pending_rts = _pending_ruletables(applied)
             else: break
 
 
@@ -254,18 +744,133 @@ def page_size(use):
 
 PAGEH, PAGEW = page_size("largest")
 
-def render(*items):
-    D = SW.drawing.Drawing(filename="/tmp/smt.svg", size=(PAGEW, PAGEH), debug=True)
+class _RenderContext:
+    """Options of one render, handed down the tree while its svg elements are made."""
+    def __init__(self, debug=True, glyph_defs=False, overlays=None):
+        # svgwrite's debug mode validates every attribute of every element.
+        self.debug = debug
+        # Bboxes and origins, see OVERLAYS.
+        self.overlays = OVERLAYS if overlays is None else overlays
+        # Write each glyph once into <defs> and <use> it.
+        self.glyph_defs = glyph_defs
+        # Ids of the glyph definitions written so far.
+        self.defined = set()
+
+def render(*items, path="/tmp/smt.svg", stream=False, debug=True, glyph_defs=False,
+           overlays=None):
+    """Lays out items and saves them as svg at path, a file name or an open (text or 
+    binary) file object, e.g. from socket.makefile(). If path is None the document is
+    returned as bytes instead. debug validates the svg attributes and pretty-prints 
+    the document, for development; without it (the production mode) the elements are 
+    streamed compactly to path. With stream the elements are also written one at a time
+    as the tree is walked in debug mode, instead of being collected into a drawing first.
+    With glyph_defs the outline of each glyph used is written only once (into <defs>, 
+    where it is first needed), characters refer to it with a transformed <use>.
+    overlays overrides OVERLAYS for this render."""
+    if path is None:
+        buf = io.BytesIO()
+        render(*items, path=buf, stream=stream, debug=debug, glyph_defs=glyph_defs,
+               overlays=overlays)
+        return buf.getvalue()
+    ctx = _RenderContext(debug=debug, glyph_defs=glyph_defs, overlays=overlays)
+    if stream or not debug:
+        with _svg_writer(path, (PAGEW, PAGEH), ctx) as writer:
+            for item in items:
+                item._apply_rules()
+                _prepare_linesegs(members(item))
+                for elem in item._svg_elements(ctx):
+                    writer.add(elem)
+        return
+    D = SW.drawing.Drawing(size=(PAGEW, PAGEH), debug=True)
     for item in items:
         item._apply_rules()
-        # Form's packsvglst will call packsvglst on descendants recursively
-        item._pack_svg_list_ip()
-        for elem in item._svg_list:
+        _prepare_linesegs(members(item))
+        # Form's svg elements include those of its descendants
+        for elem in item._svg_elements(ctx):
             D.add(elem)
-    D.save(pretty=True)
-
+    buf = io.StringIO()
+    D.write(buf, pretty=True)
+    with _output(path) as write:
+        write(buf.getvalue())
+
+@contextlib.contextmanager
+def _output(dest):
+    """Yields a function writing strings to dest, a file name or a (text or binary) file 
+    object. Files named here are opened and closed here, file objects are left open."""
+    if isinstance(dest, (str, os.PathLike)):
+        with open(dest, "w", encoding="utf-8") as file_:
+            yield file_.write
+    elif isinstance(dest, io.TextIOBase):
+        yield dest.write
+    else:
+        yield lambda s: dest.write(s.encode("utf-8"))
+
+class _SVGWriter:
+    """Writes an svg document piece by piece through write."""
+    def __init__(self, write, size, ctx):
+        self.write = write
+        self.ctx = ctx
+        svg = SW.drawing.Drawing(size=size, debug=ctx.debug).tostring()
+        self.write('<?xml version="1.0" encoding="utf-8" ?>\n' + svg[:-len("</svg>")])
+
+    def add(self, elem): self.write(elem.tostring())
+    def close(self): self.write("</svg>")
+
+@contextlib.contextmanager
+def _svg_writer(dest, size, ctx):
+    """An _SVGWriter to dest (see _output)."""
+    with _output(dest) as write:
+        writer = _SVGWriter(write, size, ctx)
+        yield writer
+        writer.close()
+
+def _render_job(job):
+    """Lays out and packs one item in a worker process, returns the svg element strings."""
+    i, item, ctx = job
+    # Objects created here are kept apart from those of other items.
+    with Document(id_prefix=f"I{i}-") as doc:
+        for m in members(item): doc._register(m)
+        item._apply_rules()
+        _prepare_linesegs(members(item))
+        return [elem.tostring() for elem in item._svg_elements(ctx)]
+
+def render_parallel(*items, path="/tmp/smt.svg", pages=False, processes=None, debug=True,
+                    glyph_defs=False, overlays=None):
+    """Renders independent items (e.g. systems or pages) in a pool of processes.
+    The items are pickled to the workers, so the objects passed in are not laid out 
+    themselves. The results are merged into one document at path or, if pages is
+    True, saved one item per file (path's name numbered). Returns the paths written.
+    debug, glyph_defs and overlays are as for render, the documents are written 
+    compactly either way."""
+    ctx = _RenderContext(debug=debug, glyph_defs=glyph_defs, overlays=overlays)
+    with multiprocessing.Pool(processes) as pool:
+        results = pool.map(_render_job, [(i, item, ctx) for i, item in enumerate(items)])
+    if pages:
+        root, ext = os.path.splitext(path)
+        docs = [(f"{root}-{i}{ext}", [r]) for i, r in enumerate(results)]
+    else:
+        docs = [(path, results)]
+    for docpath, doc_results in docs:
+        with _svg_writer(docpath, (PAGEW, PAGEH), ctx) as writer:
+            for r in doc_results:
+                for fragment in r: writer.write(fragment)
+    return [docpath for docpath, _ in docs]
+
+
+# Default styles, shared by all objects.
+_CANVAS_COLOR = SW.utils.rgb(20, 20, 20, "%")
+_MCHAR_CANVAS_COLOR = SW.utils.rgb(100, 0, 0, "%")
+_SFORM_CANVAS_COLOR = SW.utils.rgb(0, 100, 0, "%")
+_HFORM_CANVAS_COLOR = SW.utils.rgb(0, 0, 100, "%")
+_LINESEG_CANVAS_COLOR = SW.utils.rgb(100, 100, 0, "%")
+_ORIGIN_COLOR = SW.utils.rgb(87, 78, 55)
+_COLOR = SW.utils.rgb(0, 0, 0)
 
 class _Canvas(_SMTObject):
+    __slots__ = ("_skewx", "_skewy", "_is_hlineup_head", "_rotate", "canvas_opacity", 
+                 "canvas_visible", "canvas_color", "origin_visible", "_xscale", "_yscale",
+                 "_x", "x_locked", "_y", "y_locked", "_width", "_width_locked", 
+                 "_height", "height_locked", "floating")
     def __init__(self, canvas_color=None,
     canvas_opacity=None, xscale=1, yscale=1,
     x=None, y=None,
@@ -273,18 +878,18 @@ class _Canvas(_SMTObject):
     rotate=0, skewx=0, skewy=0,
     width=None, height=None,
      # width_locked=False,
-    canvas_visible=True, origin_visible=True, **kwargs):
+    canvas_visible=True, origin_visible=True, floating=False, **kwargs):
         super().__init__(**kwargs)
-        self.skewx = skewx
-        self.skewy = skewy
+        self._skewx = skewx
+        self._skewy = skewy
         # self.rotate=rotate
         # Only the first item in a hform will need _hlineup, for him 
         # this is set by HForm itself.
         self._is_hlineup_head = False
-        self.rotate=rotate
+        self._rotate = rotate
         self.canvas_opacity = canvas_opacity or 0.3
         self.canvas_visible = canvas_visible
-        self.canvas_color = canvas_color or SW.utils.rgb(20, 20, 20, "%")
+        self.canvas_color = canvas_color or _CANVAS_COLOR
         self.origin_visible = origin_visible
         self._xscale = xscale
         self._yscale = yscale
@@ -299,20 +904,74 @@ class _Canvas(_SMTObject):
         self._width_locked = False if width is None else True
         self._height = 0 if height is None else height
         self.height_locked = False if height is None else True
+        # Floating objects are left out of the lineups of their parent H/VForms, 
+        # e.g. staff lines drawn across a whole system.
+        self.floating = floating
         
     @property
     def xscale(self): return self._xscale
     @property
     def yscale(self): return self._yscale
     
+    @property
+    def rotate(self): return self._rotate
+    @rotate.setter
+    def rotate(self, new):
+        self._rotate = new
+        self._transform_changed()
+    @property
+    def skewx(self): return self._skewx
+    @skewx.setter
+    def skewx(self, new):
+        self._skewx = new
+        self._transform_changed()
+    @property
+    def skewy(self): return self._skewy
+    @skewy.setter
+    def skewy(self, new):
+        self._skewy = new
+        self._transform_changed()
+    
+    def _transform_changed(self):
+        """Called whenever rotation or skew have been changed."""
+        pass
+    
+    # Ancestors are outdated once our extents have changed. Dirty flags always 
+    # propagate up to the root, so we can stop at the first dirty ancestor.
+    def _horizontals_changed(self):
+        if LAZY_LAYOUT:
+            for a in self._iter_ancestors():
+                if a._hdirty: break
+                a._hdirty = True
+        else:
+            for a in self._iter_ancestors():
+                a._compute_horizontals()
+    
+    def _verticals_changed(self):
+        if LAZY_LAYOUT:
+            for a in self._iter_ancestors():
+                if a._vdirty: break
+                a._vdirty = True
+        else:
+            for a in self._iter_ancestors():
+                a._compute_verticals()
+    
     # def unlock(what):
         # if what == "y":
             # self.y_locked = False
     
+    # _x & _y are relative to the parent's origin (absolute for roots), x & y
+    # resolve them to absolute coordinates. Moving a form so moves all of it's
+    # descendants along without touching them.
     @property
-    def x(self): return self._x
+    def x(self): return self._x + self._parent.x if self._parent else self._x
     @property
-    def y(self): return self._y
+    def y(self): return self._y + self._parent.y if self._parent else self._y
+    
+    def _relate_to(self, parent):
+        """Turns our absolute root coordinates into offsets from the new parent."""
+        self._x -= parent.x
+        self._y -= parent.y
     
     # # Placeholders
     # @property
@@ -349,52 +1008,56 @@ class _Canvas(_SMTObject):
                                 # fill_opacity=obj.canvas_opacity, 
                                 # id_=obj.id + "BBox")
 
+# Overlays are the debugging chrome drawn around objects: bboxes and origins (as far
+# as canvas_visible/origin_visible permit). Without them neither these elements nor
+# the geometry they need are computed. render's overlays overrides this.
+OVERLAYS = True
+
 _ORIGIN_CROSS_LEN = 20
 _ORIGIN_CIRCLE_R = 4
 _ORIGIN_LINE_THICKNESS = 0.06
-def _origelems(obj):
+def _origelems(obj, ctx):
     halfln = _ORIGIN_CROSS_LEN / 2
     return [SW.shapes.Circle(center=(obj.x, obj.y), r=_ORIGIN_CIRCLE_R,
                                     id_=obj.id + "OriginCircle",
-                                    stroke=SW.utils.rgb(87, 78, 55), fill="none",
-                                    stroke_width=_ORIGIN_LINE_THICKNESS),
+                                    stroke=_ORIGIN_COLOR, fill="none",
+                                    stroke_width=_ORIGIN_LINE_THICKNESS, debug=ctx.debug),
             SW.shapes.Line(start=(obj.x-halfln, obj.y), end=(obj.x+halfln, obj.y),
                                         id_=obj.id + "OriginHLine",
-                                        stroke=SW.utils.rgb(87, 78, 55), 
-                                        stroke_width=_ORIGIN_LINE_THICKNESS),
+                                        stroke=_ORIGIN_COLOR, 
+                                        stroke_width=_ORIGIN_LINE_THICKNESS, debug=ctx.debug),
             SW.shapes.Line(start=(obj.x, obj.y-halfln), end=(obj.x, obj.y+halfln),
                                         id_=obj.id + "OriginVLine",
-                                        stroke=SW.utils.rgb(87, 78, 55), 
-                                        stroke_width=_ORIGIN_LINE_THICKNESS)]
+                                        stroke=_ORIGIN_COLOR, 
+                                        stroke_width=_ORIGIN_LINE_THICKNESS, debug=ctx.debug)]
 
 
 class _Font:
     """Adds font to MChar & Form"""
+    __slots__ = ()
     def __init__(self, font=None):
-        self.font = font or tuple(_loaded_fonts.keys())[0]
+        self.font = font or _default_font()
 
 
 class _Observable(_Canvas):
-    
+    __slots__ = ("color", "opacity", "visible")
     def __init__(self, color=None, opacity=None, visible=True, **kwargs):
         super().__init__(**kwargs)
-        self.color = color or SW.utils.rgb(0, 0, 0)
+        self.color = color or _COLOR
         self.opacity = opacity or 1
         self.visible = visible
     
     @_Canvas.x.setter
     def x(self, new):
         if not self.x_locked:
-            self._x = new
-            for a in reversed(self.ancestors):
-                a._compute_horizontals()
+            self._x = new - self._parent.x if self._parent else new
+            self._horizontals_changed()
     
     @_Canvas.y.setter
     def y(self, new):
         if not self.y_locked:
-            self._y = new
-            for a in reversed(self.ancestors):
-                a._compute_verticals()
+            self._y = new - self._parent.y if self._parent else new
+            self._verticals_changed()
     
     def _bbox(self): self._notimplemented("_bbox")
         # raise NotImplementedError(f"_bbox method not overriden by {self.__class__.__name__}!")  
@@ -423,6 +1086,7 @@ class _Observable(_Canvas):
         
 class MChar(_Observable, _Font):
     
+    __slots__ = ("font", "name", "_glyph", "_local_matrix", "_local_bbox")
     _idcounter = -1
     
     def __init__(self, name, font=None, **kwargs):
@@ -431,24 +1095,34 @@ class MChar(_Observable, _Font):
         self.name = name
         # self.glyph = _getglyph(self.name, self.font)
         self._glyph = _get_glyph(self.name, self.font)
+        # Our transformation without the translation (see _affine) and the bbox 
+        # of the glyph relative to our origin, None if outdated.
+        self._local_matrix = None
+        self._local_bbox = None
         # self._se_path = SE.Path(self.glyph, transform)
         # self.bbox = SPT.Path(self.glyph).bbox()
         # self._path = SPT.Path(_get_glyph_d(self.name, self.font))
-        self.canvas_color = SW.utils.rgb(100, 0, 0, "%")
+        self.canvas_color = _MCHAR_CANVAS_COLOR
         # self._compute_horizontals()
         # self._compute_verticals()
     
     @_Canvas.xscale.setter
     def xscale(self, new):
         self._xscale = new
-        for a in reversed(self.ancestors):
-            a._compute_horizontals()
+        self._local_matrix = self._local_bbox = None
+        self._horizontals_changed()
     
     @_Canvas.yscale.setter
     def yscale(self, new):
         self._yscale = new
-        for a in reversed(self.ancestors):
-            a._compute_verticals()
+        self._local_matrix = self._local_bbox = None
+        self._verticals_changed()
+    
+    def _transform_changed(self):
+        # Rotation & skew change both dimensions.
+        self._local_matrix = self._local_bbox = None
+        self._horizontals_changed()
+        self._verticals_changed()
         
     
     # @_Canvas.x.setter
@@ -524,40 +1198,56 @@ class MChar(_Observable, _Font):
             # for elem in _origelems(self):
                 # self._svg_list.append(elem)
     
-    def _pack_svg_list_ip(self):
-        if self.canvas_visible:
-            self._svg_list.append(SW.path.Path(
-                d=SPT.bbox2path(*self._bbox()).d(),
+    def _svg_elements(self, ctx):
+        yield from self._svg_list
+        if ctx.overlays and self.canvas_visible:
+            yield SW.path.Path(
+                d=_bboxpath_d(*self._bbox()),
                 fill=self.canvas_color,
                 fill_opacity=self.canvas_opacity, 
-                id_=f"{self.id}-BBox")
-                )
+                id_=f"{self.id}-BBox", debug=ctx.debug)
         # Music character itself
-        self._svg_list.append(SW.path.Path(
-            d=self._path().d(), id_=self.id,
-            fill=self.color, fill_opacity=self.opacity,
-            # transform="translate({0} {1}) scale({2} {3})".format(
-                # self.x, self.y, self.xscale * _scale(), self.yscale * _scale())
-        ))
+        if ctx.glyph_defs:
+            yield from self._glyph_use(ctx)
+        else:
+            yield SW.path.Path(
+                d=self._glyph["d"], id_=self.id, transform=self._svg_matrix(),
+                fill=self.color, fill_opacity=self.opacity, debug=ctx.debug,
+            )
         # Add the origin
-        if self.origin_visible:
-            for elem in _origelems(self):
-                self._svg_list.append(elem)
-    
-    # svgelements
-    def _path(self):
-        path = SE.Path(self._glyph)
-        path *= f"scale({self.xscale * _scale()}, {self.yscale * _scale()})"
-        # First rotate at 00,
-        path *= f"rotate({self.rotate}deg)"
-        # then move.
-        path *= f"translate({self.x}, {self.y})"
-        return path
-        # return SE.Path(self._glyph, transform=f"rotate({self.rotate}) scale({self.xscale*_scale()} {self.yscale*_scale()})")
-    
-    # svgelements bbox seems to have a bug getting bboxes of transformed (rotated) paths,
-    # use svgpathtools bbox instead (xmin, xmax, ymin, ymax).
-    def _bbox(self): return SPT.Path(self._path().d()).bbox()
+        if ctx.overlays and self.origin_visible:
+            yield from _origelems(self, ctx)
+    
+    def _glyph_use(self, ctx):
+        """Yields a <use> of our glyph, preceded by the glyph's definition if
+        this is its first use in the render."""
+        # Ids of items rendered in parallel are prefixed, so are their definitions.
+        glyph_id = _document.id_prefix + re.sub(r"[^\w.-]", "_", f"{self.font}-{self.name}")
+        if glyph_id not in ctx.defined:
+            ctx.defined.add(glyph_id)
+            defs = SW.container.Defs(debug=ctx.debug)
+            defs.add(SW.path.Path(d=self._glyph["d"], id_=glyph_id, debug=ctx.debug))
+            yield defs
+        yield SW.container.Use(f"#{glyph_id}", id_=self.id, transform=self._svg_matrix(),
+                               fill=self.color, fill_opacity=self.opacity, debug=ctx.debug)
+
+    def _matrix(self):
+        """Our transformation (a, b, c, d, e, f) as in svg's matrix: scale, skew and
+        rotate at 00, then move to xy."""
+        if self._local_matrix is None:
+            self._local_matrix = _affine(self.xscale * _scale(), self.yscale * _scale(),
+                                         self.skewx, self.skewy, self.rotate)
+        return (*self._local_matrix, self.x, self.y)
+    
+    def _svg_matrix(self): return "matrix({} {} {} {} {} {})".format(*self._matrix())
+    
+    # xmin, xmax, ymin, ymax. The transformed glyph's bbox is cached, moving the
+    # char only shifts it.
+    def _bbox(self):
+        if self._local_bbox is None:
+            self._local_bbox = _glyph_bbox(self.name, self.font, self._matrix()[:4])
+        xmin, xmax, ymin, ymax = self._local_bbox
+        return xmin + self.x, xmax + self.x, ymin + self.y, ymax + self.y
     
     # @property
     # def left(self): return self._bbox()[0]
@@ -582,10 +1272,18 @@ class MChar(_Observable, _Font):
 
 class _Form(_Canvas, _Font):
 
+    __slots__ = ("font", "content", "_hdirty", "_vdirty", "_gens", "_members", 
+                 "fixtop", "fixbottom", "FIXHEIGHT", "_left", "_right", "_top", "_bottom")
     _idcounter = 0
 
     def __init__(self, font=None, content=None, **kwargs):
         self.content = content or []
+        # Extents are outdated until computed.
+        self._hdirty = True
+        self._vdirty = True
+        # Caches of descendants() & members(), None when outdated.
+        self._gens = None
+        self._members = None
         _Canvas.__init__(self, **kwargs)
         _Font.__init__(self, font)
         # These attributes preserve information about the Height of a form object. These info
@@ -602,8 +1300,9 @@ class _Form(_Canvas, _Font):
         self.FIXHEIGHT = toplevel_scale(_get_glyph(STAFF_HEIGHT_REFERENCE_GLYPH, self.font)["height"])
         
         
-        for D in descendants(self, False):
-            D.ancestors.insert(0, self) # Need smteq??
+        for c in self.content:
+            c._relate_to(self)
+            c._parent = self
         for c in self.content:
             # These assignments take place only if xy are not locked!
             c.x = self.x
@@ -626,63 +1325,85 @@ class _Form(_Canvas, _Font):
     def delcont(self, test):
         for i, c in enumerate(self.content):
             if test(c): del self.content[i]
+        self._structure_changed()
     
+    def _generations(self):
+        """Returns the descendants as a list of generations: [children, grandchildren, ...].
+        Built from the children's own generations and cached until the structure changes."""
+        if self._gens is None:
+            gens = [list(self.content)]
+            for c in self.content:
+                if isinstance(c, _Form):
+                    for i, gen in enumerate(c._generations(), 1):
+                        if i == len(gens): gens.append([])
+                        gens[i].extend(gen)
+            self._gens = gens
+        return self._gens
+    
+    def _structure_changed(self):
+        """Drops the cached descendants of self and of all ancestors. A cache is never
+        built without the caches of the descendants, so we can stop at the first 
+        ancestor without one."""
+        self._gens = self._members = None
+        for A in self._iter_ancestors():
+            if A._gens is None: break
+            A._gens = A._members = None
+    
+    # _left, _right, _top & _bottom are kept relative to the form's x & y.
     def _compute_horizontals(self):
-        self._left = self._compute_left()
-        self._right = self._compute_right()
+        # Clear the flag first, computing reads our own extents.
+        self._hdirty = False
+        _prepare_linesegs(self.content)
+        x = self.x
+        self._left = self._compute_left() - x
+        self._right = self._compute_right() - x
         self._width = self._compute_width()
 
     def _compute_verticals(self):
-        self._top = self._compute_top()
-        self._bottom = self._compute_bottom()
+        self._vdirty = False
+        _prepare_linesegs(self.content)
+        y = self.y
+        self._top = self._compute_top() - y
+        self._bottom = self._compute_bottom() - y
         self._height = self._compute_height()
+    
+    def layout(self):
+        """Brings outdated extents of the form and it's descendants up to date."""
+        # The geometry of all line segments in one go.
+        _prepare_linesegs(members(self))
+        if self._hdirty: self._compute_horizontals()
+        if self._vdirty: self._compute_verticals()
+    
+    def _content_changed(self):
+        """Our extents must be recomputed from the content."""
+        if LAZY_LAYOUT:
+            self._hdirty = self._vdirty = True
+            self._horizontals_changed()
+            self._verticals_changed()
+        else:
+            self._compute_horizontals()
+            self._compute_verticals()
 
-    # Children is a sequence. This method modifies only ancestor lists.
+    # Children is a sequence. This method only sets the children's parent.
     def _establish_parental_relationship(self, children):
         for child in children:
             assert isinstance(child, _SMTObject), "Form can only contain MeObjs!"
-            child.ancestors.insert(0, self)
-            if isinstance(child, _Form):
-                for D in descendants(child, False):
-                    D.ancestors.insert(0, self)
-            for A in reversed(self.ancestors):
-                child.ancestors.insert(0, A)
-                if isinstance(child, _Form):
-                    for D in descendants(child, False):
-                        D.ancestors.insert(0, A)
+            child._relate_to(self)
+            child._parent = self
 
+    # Descendants and our extents are relative to us, they move along for free.
     @_Canvas.x.setter
     def x(self, new):
         if not self.x_locked:
-            dx = new - self.x
-            self._x = new
-            self._left += dx
-            self._right += dx
-            for D in descendants(self, False):
-                # Descendants' x are shifted by delta-x. 
-                D._x += dx
-                if isinstance(D, _Form):
-                    D._left += dx
-                    D._right += dx
-            for A in reversed(self.ancestors):
-                A._compute_horizontals()
+            self._x = new - self._parent.x if self._parent else new
+            self._horizontals_changed()
 
     @_Canvas.y.setter
     def y(self, new):
         if not self.y_locked:
-            dy = new - self.y
-            self._y = new
-            self._top += dy
-            self._bottom += dy
-            for D in descendants(self, False):
-                D._y += dy
-                if isinstance(D, _Form):
-                    # # D._y += dy
-                    D._top += dy
-                    D._bottom += dy
+            self._y = new - self._parent.y if self._parent else new
             # Shifting Y might have an impact on ancestor's width!
-            for A in reversed(self.ancestors):
-                A._compute_verticals()
+            self._verticals_changed()
     
     def _compute_left(self):
         """Determines the left-most of either: form's own x coordinate 
@@ -717,26 +1438,24 @@ class _Form(_Canvas, _Font):
     def _compute_height(self): 
         return self.height if self.height_locked else self.bottom - self.top
     
-    def _pack_svg_list_ip(self):
+    def _svg_elements(self, ctx):
+        yield from self._svg_list
         # Bbox
-        if self.canvas_visible: 
-            # self._svg_list.append(_bboxelem(self))
-            self._svg_list.append(
-                SW.shapes.Rect(insert=(self.left, self.top),
-                                size=(self.width, self.height), 
-                                fill=self.canvas_color,
-                                fill_opacity=self.canvas_opacity, 
-                                id_=f"{self.id}-BBox")
-            )
+        if ctx.overlays and self.canvas_visible: 
+            yield SW.shapes.Rect(insert=(self.left, self.top),
+                                 size=(self.width, self.height), 
+                                 fill=self.canvas_color,
+                                 fill_opacity=self.canvas_opacity, 
+                                 id_=f"{self.id}-BBox", debug=ctx.debug)
         # Add content
         for C in self.content:
             # C.xscale *= self.xscale
             # C.yscale *= self.yscale
-            # Recursively pack svg elements of each child:
-            C._pack_svg_list_ip() 
-            self._svg_list.extend(C._svg_list)
+            # Recursively yield svg elements of each child, nothing is collected
+            # on the way up.
+            yield from C._svg_elements(ctx)
         # Origin
-        if self.origin_visible: self._svg_list.extend(_origelems(self))
+        if ctx.overlays and self.origin_visible: yield from _origelems(self, ctx)
         
     # def _pack_svg_list_ip(self):
         # # Bbox
@@ -757,17 +1476,29 @@ class _Form(_Canvas, _Font):
         # # if self.origin_visible: self._svg_list.extend(_origelems(self))
         
     @property
-    def left(self): return self._left
+    def left(self):
+        if self._hdirty: self._compute_horizontals()
+        return self.x + self._left
     @property
-    def right(self): return self._right
+    def right(self):
+        if self._hdirty: self._compute_horizontals()
+        return self.x + self._right
     @property
-    def top(self): return self._top
+    def top(self):
+        if self._vdirty: self._compute_verticals()
+        return self.y + self._top
     @property
-    def bottom(self): return self._bottom
+    def bottom(self):
+        if self._vdirty: self._compute_verticals()
+        return self.y + self._bottom
     @property
-    def width(self): return self._width
+    def width(self):
+        if self._hdirty: self._compute_horizontals()
+        return self._width
     @property
-    def height(self): return self._height
+    def height(self):
+        if self._vdirty: self._compute_verticals()
+        return self._height
     
     # Setters
     @left.setter
@@ -783,11 +1514,11 @@ class _Form(_Canvas, _Font):
     @width.setter
     def width(self, new):
         if not self._width_locked:
-            self._right = self.left + new
+            if self._hdirty: self._compute_horizontals()
+            self._right = self._left + new
             self._width = new
             # self.right = self.left + new
-            for A in reversed(self.ancestors):
-                A._compute_horizontals()
+            self._horizontals_changed()
     
     # # SPT bbox output: xmin, xmax, ymin, ymax
     # def _bbox(self):
@@ -805,10 +1536,11 @@ class _Form(_Canvas, _Font):
 
 
 class SForm(_Form):
-        
+    
+    __slots__ = ()
     def __init__(self, **kwargs):
         _Form.__init__(self, **kwargs)
-        self.canvas_color = SW.utils.rgb(0, 100, 0, "%")
+        self.canvas_color = _SFORM_CANVAS_COLOR
         self.domain = kwargs.get("domain", "stacked")
         # Content may contain children with absolute x, so compute horizontals with respect to them.
         # See whats happening in _Form init with children without absx!
@@ -823,23 +1555,25 @@ class SForm(_Form):
             c.x = self.x
             c.y = self.y
         self.content.extend(children)
+        self._structure_changed()
         # # Having set the content before would have caused assign_x to trigger computing horizontals for the Form,
         # # which would have been to early!????
-        self._compute_horizontals()
-        self._compute_verticals()
-        for A in reversed(self.ancestors):
+        self._content_changed()
+        for A in self._iter_ancestors():
             if isinstance(A, _Form) and not isinstance(A, SForm):
-                A._lineup()
-            A._compute_horizontals()
-            A._compute_verticals()
+                _lineup_later(A)
+            if not LAZY_LAYOUT:
+                A._compute_horizontals()
+                A._compute_verticals()
 
 
 class HForm(_Form):
 
+    __slots__ = ()
     def __init__(self, **kwargs):
         _Form.__init__(self, **kwargs)
         # self.abswidth = abswidth
-        self.canvas_color = SW.utils.rgb(0, 0, 100, "%")
+        self.canvas_color = _HFORM_CANVAS_COLOR
         self.domain = kwargs.get("domain", "horizontal")
         # Lineup content created at init-time,
         self._lineup()
@@ -848,17 +1582,37 @@ class HForm(_Form):
         self._compute_verticals()
             
     def _lineup(self):
-        for a, b in zip(self.content[:-1], self.content[1:]):            
+        flow = [c for c in self.content if not c.floating]
+        for a, b in zip(flow[:-1], flow[1:]):
             b.left = a.right
+    
+    def append(self, *children):
+        """Appends new children to Form's content list."""
+        self._establish_parental_relationship(children)
+        for c in children:
+            c.x = self.x
+            c.y = self.y
+        self.content.extend(children)
+        self._structure_changed()
+        _lineup_later(self)
+        self._content_changed()
+        for A in self._iter_ancestors():
+            if isinstance(A, _Form) and not isinstance(A, SForm): # V & H
+                _lineup_later(A)
+            if not LAZY_LAYOUT:
+                A._compute_horizontals()
+                A._compute_verticals()
 
 class VForm(_Form):
+    __slots__ = ()
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
         self._lineup()
         self._compute_horizontals()
         self._compute_verticals()
     def _lineup(self):
-        for a, b in zip(self.content[:-1], self.content[1:]):
+        flow = [c for c in self.content if not c.floating]
+        for a, b in zip(flow[:-1], flow[1:]):
             b.top = a.bottom
     def append(self, *children):
         """Appends new children to Form's content list."""
@@ -867,33 +1621,76 @@ class VForm(_Form):
             c.x = self.x
             c.y = self.y
         self.content.extend(children)
+        self._structure_changed()
         # # Having set the content before would have caused assign_x to trigger computing horizontals for the Form,
         # # which would have been to early!????
-        self._lineup()
-        self._compute_horizontals()
-        self._compute_verticals()
-        for A in reversed(self.ancestors):
+        _lineup_later(self)
+        self._content_changed()
+        for A in self._iter_ancestors():
             if isinstance(A, _Form) and not isinstance(A, SForm): # V & H
-                A._lineup()
-            A._compute_horizontals()
-            A._compute_verticals()
+                _lineup_later(A)
+            if not LAZY_LAYOUT:
+                A._compute_horizontals()
+                A._compute_verticals()
         
 # https://github.com/meerk40t/svgelements/issues/102
+def _lineseg_geometry(segs):
+    """Computes the geometry of the line segments segs in one batch: the affine matrix
+    (a, b, c, d) of the rotated, skewed and mirrored rect and the exact bbox 
+    (xmin, xmax, ymin, ymax) of the transformed rect, both relative to the segment's
+    origin. Each segment keeps them in _local_geom."""
+    p = np.array([(*S._local_rect(), S._mirror(), S.skewx, S.skewy, S.rotate) for S in segs], 
+                 dtype=float).reshape(-1, 10)
+    x, y, w, h, rx, ry, m, skx, sky, rot = p.T
+    # Like svgelements corners are rounded only if both radii are given, at most
+    # half the side.
+    rounded = (rx != 0) & (ry != 0)
+    rx = np.where(rounded, np.minimum(np.abs(rx), np.abs(w) * .5), 0)
+    ry = np.where(rounded, np.minimum(np.abs(ry), np.abs(h) * .5), 0)
+    tx, ty = np.tan(np.radians(skx)), np.tan(np.radians(sky))
+    cos, sin = np.cos(np.radians(rot)), np.sin(np.radians(rot))
+    # rotate(rot) skew(skx, sky) scale(m, 1), as in svg's matrix(a b c d e f).
+    a = (cos - sin * ty) * m
+    b = (sin + cos * ty) * m
+    c = cos * tx - sin
+    d = sin * tx + cos
+    # The rounded rect is its inner rect swept by the corner ellipse. The transformed 
+    # ellipse reaches hypot(a*rx, c*ry) to the left and right, hypot(b*rx, d*ry) up and down.
+    cx = np.stack([x + rx, x + w - rx, x + w - rx, x + rx], axis=1)
+    cy = np.stack([y + ry, y + ry, y + h - ry, y + h - ry], axis=1)
+    X = a[:, None] * cx + c[:, None] * cy
+    Y = b[:, None] * cx + d[:, None] * cy
+    ex, ey = np.hypot(a * rx, c * ry), np.hypot(b * rx, d * ry)
+    bboxes = np.stack([X.min(axis=1) - ex, X.max(axis=1) + ex, 
+                       Y.min(axis=1) - ey, Y.max(axis=1) + ey], axis=1)
+    for S, M, B in zip(segs, np.stack([a, b, c, d], axis=1).tolist(), bboxes.tolist()):
+        S._local_geom = (tuple(M), tuple(B))
+
+def _prepare_linesegs(objs):
+    """Computes the missing geometry of all line segments among objs at once."""
+    segs = [O for O in objs if isinstance(O, _LineSeg) and O._local_geom is None]
+    if segs: _lineseg_geometry(segs)
+
+
 class _LineSeg(_Observable):
     """Angle in degrees"""
+    __slots__ = ("_length", "_angle", "_thickness", "_direction", "_endxr", "_endyr", 
+                 "_local_geom")
     _idcounter = -1
     def __init__(self, length=None, direction=None, thickness=None, angle=None, endxr=None, endyr=None,
     # start=None, end=None,
     **kwargs):
         super().__init__(**kwargs)
-        self.length = length or 0
+        self._length = length or 0
         # self.color = color or SW.utils.rgb(0, 0, 0)
         # self.opacity = opacity
         self._angle = angle or 0
         self._thickness = thickness or 0
-        self.direction = direction or 1
-        self.endxr = endxr or 0
-        self.endyr = endyr or 0
+        self._direction = direction or 1
+        self._endxr = endxr or 0
+        self._endyr = endyr or 0
+        # (matrix, bbox) relative to our origin, see _lineseg_geometry.
+        self._local_geom = None
         # self.start = start
         # self.end = end
         # self._x2 = 
@@ -902,23 +1699,26 @@ class _LineSeg(_Observable):
         # self._compute_verticals()
 
 
-    # Override canvas packsvglist
-    def _pack_svg_list_ip(self):
+    # Override canvas svg elements
+    def _svg_elements(self, ctx):
+        yield from self._svg_list
         # bbox
-        self._svg_list.append(SW.path.Path(
-                d=SPT.bbox2path(*self._bbox()).d(),
-                fill=SW.utils.rgb(100,100,0,"%"),
-                fill_opacity=self.canvas_opacity, 
-                id_=f"{self.id}-BBox")
-                )
-        self._svg_list.append(SW.path.Path(
-            d=self._rect().d(),
-            fill=self.color, fill_opacity=self.opacity
-        ))
+        if ctx.overlays:
+            yield SW.path.Path(
+                    d=_bboxpath_d(*self._bbox()),
+                    fill=_LINESEG_CANVAS_COLOR,
+                    fill_opacity=self.canvas_opacity, 
+                    id_=f"{self.id}-BBox", debug=ctx.debug)
+        if self._local_geom is None: _lineseg_geometry([self])
+        (a, b, c, d), _ = self._local_geom
+        yield SW.path.Path(
+            d=self._local_d(),
+            transform=f"matrix({a} {b} {c} {d} {self.x} {self.y})",
+            fill=self.color, fill_opacity=self.opacity, debug=ctx.debug
+        )
         # Add the origin
-        if self.origin_visible:
-            for elem in _origelems(self):
-                self._svg_list.append(elem)
+        if ctx.overlays and self.origin_visible:
+            yield from _origelems(self, ctx)
         
         
     # @property
@@ -946,9 +1746,63 @@ class _LineSeg(_Observable):
     
     @property
     def thickness(self): return self._thickness
+    @property
+    def length(self): return self._length
+    @length.setter
+    def length(self, new):
+        self._length = new
+        self._shape_changed()
+    @property
+    def direction(self): return self._direction
+    @direction.setter
+    def direction(self, new):
+        self._direction = new
+        self._shape_changed()
+    @property
+    def endxr(self): return self._endxr
+    @endxr.setter
+    def endxr(self, new):
+        self._endxr = new
+        self._shape_changed()
+    @property
+    def endyr(self): return self._endyr
+    @endyr.setter
+    def endyr(self, new):
+        self._endyr = new
+        self._shape_changed()
+    
+    def _shape_changed(self):
+        self._local_geom = None
+        self._horizontals_changed()
+        self._verticals_changed()
+    
+    def _transform_changed(self): self._shape_changed()
+    
+    def _mirror(self):
+        """-1 flips the rect horizontally about our origin."""
+        return 1
+    
+    def _local_rect(self):
+        """The untransformed rect (x, y, width, height, rx, ry) relative to our origin."""
+        self._notimplemented("_local_rect")
+    
+    def _local_d(self):
+        """The d of our untransformed (rounded) rect, relative to our origin."""
+        x, y, w, h, rx, ry = self._local_rect()
+        if not (rx and ry):
+            return f"M {x},{y} h {w} v {h} h {-w} Z"
+        rx, ry = min(abs(rx), abs(w) * .5), min(abs(ry), abs(h) * .5)
+        arc = f"A {rx},{ry} 0 0,1"
+        return (f"M {x+rx},{y} H {x+w-rx} {arc} {x+w},{y+ry} V {y+h-ry} "
+                f"{arc} {x+w-rx},{y+h} H {x+rx} {arc} {x},{y+h-ry} V {y+ry} "
+                f"{arc} {x+rx},{y} Z")
+    
     # xmin, xmax, ymin, ymax
     def _bbox(self): 
-        return SPT.Path(self._rect().d()).bbox()
+        if self._local_geom is None: _lineseg_geometry([self])
+        xmin, xmax, ymin, ymax = self._local_geom[1]
+        x, y = self.x, self.y
+        return xmin + x, xmax + x, ymin + y, ymax + y
 
 
 
@@ -958,6 +1812,7 @@ class _LineSeg(_Observable):
 
 
 class VLineSeg(_LineSeg):
+    __slots__ = ()
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
         
@@ -970,16 +1825,8 @@ class VLineSeg(_LineSeg):
         # R *= f"rotate({self.angle()}rad {self.x} {self.y})"
         # return R
     
-    def _rect(self):
-        rect = SE.Rect(
-            # Rect(x, y, width, height, rx, ry, matrix, stroke, fill)
-            self.x - self.thickness*.5, self.y, 
-            self.thickness, self.length,
-            self.endxr, self.endyr
-            )
-        rect *= f"skew({self.skewx}, {self.skewy}, {self.x}, {self.y})"
-        rect *= f"rotate({self.rotate}deg, {self.x}, {self.y})"
-        return rect
+    def _local_rect(self):
+        return (-self.thickness*.5, 0, self.thickness, self.length, self.endxr, self.endyr)
     
 
     
@@ -1014,18 +1861,13 @@ class VLineSeg(_LineSeg):
             # a._compute_verticals()
 
 class HLineSeg(_LineSeg):
+    __slots__ = ()
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
-    def _rect(self):
-        rect = SE.Rect(
-            self.x, self.y - self.thickness*.5,
-            self.length, self.thickness,
-            self.endxr, self.endyr
-            )
-        rect *= f"scale({self.direction} 1)"
-        rect *= f"skew({self.skewx}, {self.skewy}, {self.x}, {self.y})"
-        rect *= f"rotate({self.rotate}deg, {self.x}, {self.y})"
-        return rect
+    def _local_rect(self):
+        return (0, -self.thickness*.5, self.length, self.thickness, self.endxr, self.endyr)
+    # Direction mirrors us about our origin.
+    def _mirror(self): return self.direction
     # def _compute_width(self): return self.length
     # def _compute_height(self): return self.thickness
     # def _compute_left(self): return self.x
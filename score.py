@@ -8,7 +8,10 @@ Conveniece for creating score objects
 import engine as E
 
 
+# Like the engine's mixins Clock and _Pitch have empty slots, their attributes
+# are slots of the classes using them.
 class Clock:
+    __slots__ = ()
     def __init__(self, duration=None):
         self.duration = duration or 0.25
 
@@ -17,38 +20,58 @@ def allclocks(form):
     return all(map(lambda C: isinstance(C, Clock), form.content))
 
 def clock_chunks(content_list):
-    indices = []
-    for i in range(len(content_list)):
-        if isinstance(content_list[i], Clock):
-            indices.append(i)
+    """Splits content_list in one pass into chunks, each starting with a Clock followed by
+    the non-clocks up to the next one. Anything before the first Clock is left out."""
     chunks = []
-    for start, end in zip(indices[:-1], indices[1:]):
-        chunks.append(content_list[start:end])
-    chunks.append(content_list[indices[-1]:])
+    for c in content_list:
+        if isinstance(c, Clock): chunks.append([c])
+        elif chunks: chunks[-1].append(c)
     return chunks
 
 class _Pitch:
+    __slots__ = ()
     def __init__(self, pitch):
         self.pitch = pitch
 
 
 
-class Staff(E.VForm):
-    def __init__(self, count=5, dist=3, **kwargs):
-        c = []
-        for i in range(count):
-            c.append(E.SForm(content=[E.HLineSeg(length=20, thickness=1)], height=1))
-        super().__init__(content=c, **kwargs)
+class Staff(E.SForm):
+    """count horizontal lines of length, space apart (by default the reference
+    glyph's height split evenly), from fixtop down. Floats, i.e. is not lined up 
+    with its siblings."""
+    __slots__ = ()
+    def __init__(self, length=0, count=5, space=None, thickness=1, **kwargs):
+        kwargs.setdefault("floating", True)
+        super().__init__(content=[E.HLineSeg(length=length, thickness=thickness)
+                                  for _ in range(count)], **kwargs)
+        if space is None: space = self.FIXHEIGHT / (count - 1)
+        # The first line at the top of the reference glyph, like the staff of a form
+        # at the same y.
+        for i, line in enumerate(self.content):
+            line.y = self.fixtop + i * space
 
 class Stem(E.VLineSeg):
+    __slots__ = ()
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
 
 class OpenBeam(E.HLineSeg):
+    __slots__ = ()
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
 
+class Beam(E.HLineSeg):
+    """The beam of level (1 for eighths, 2 for sixteenths) across notes. Floats."""
+    __slots__ = ("notes", "level")
+    def __init__(self, notes=(), level=1, **kwargs):
+        kwargs.setdefault("floating", True)
+        self.notes = list(notes)
+        self.level = level
+        super().__init__(**kwargs)
+
 class Note(E.SForm, Clock, _Pitch):
+    __slots__ = ("duration", "pitch", "_obeam_graver", "_cbeam_graver", "_head_punch", 
+                 "_stem_graver")
     def __init__(self, head_punch=None, stem_graver=None, obeam_graver=None, cbeam_graver=None,
     duration=None, pitch=None, **kwargs):
         Clock.__init__(self, duration)
@@ -92,6 +115,7 @@ class Note(E.SForm, Clock, _Pitch):
 
 
 class Accidental(E.SForm, _Pitch):
+    __slots__ = ("pitch", "_punch")
     def __init__(self, punch=None, pitch=None, **kwargs):
         E.SForm.__init__(self, **kwargs)
         _Pitch.__init__(self, pitch)
@@ -109,6 +133,7 @@ class Accidental(E.SForm, _Pitch):
 
 
 class Clef(E.SForm, _Pitch):
+    __slots__ = ("pitch", "_punch")
     def __init__(self, pitch=None, **kwargs):
         E.SForm.__init__(self, **kwargs)
         _Pitch.__init__(self, pitch)
@@ -123,6 +148,7 @@ class Clef(E.SForm, _Pitch):
         self.append(self._punch)
 
 class SimpleTimeSig(E.VForm):
+    __slots__ = ("num", "denom", "_num_punch", "_denom_punch")
     def __init__(self, num=4, denom=4, **kwargs):
         self.num=num
         self.denom=denom